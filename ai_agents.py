@@ -1,28 +1,147 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import os
 import sys
-from langchain_groq import ChatGroq
+import argparse
+import array
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import difflib
+import functools
+import itertools
+import hashlib
+import inspect
+import re
+import sqlite3
+import threading
+import uuid
+import weakref
+import zlib
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 import json
-from typing import Dict, Any
-from pymongo import MongoClient
+import random
+from typing import Dict, Any, Optional
 from dotenv import load_dotenv
 load_dotenv()
 
+# langchain_groq and pymongo are imported on first use so that importing this module
+# stays cheap and never connects to Groq or MongoDB
+
+_lazy_lock = threading.RLock()
+
+def _memoize(factory):
+    """Memoizes a factory per argument tuple; safe when first called from several threads."""
+    cache = {}
+
+    @functools.wraps(factory)
+    def wrapper(*args):
+        try:
+            return cache[args]
+        except KeyError:
+            pass
+        with _lazy_lock:
+            if args not in cache:
+                cache[args] = factory(*args)
+            return cache[args]
 
+    wrapper.cache_clear = cache.clear
+    return wrapper
+
+def _memoize_per_loop(factory):
+    """
+    Like `_memoize`, but calls made inside a running event loop get instances of their own
+    loop: async HTTP clients stay bound to the loop that first used them, so sharing them
+    across `asyncio.run` calls fails. Outside an event loop one shared instance is used.
+    """
+    shared = _memoize(factory)
+    per_loop = weakref.WeakKeyDictionary()
+
+    @functools.wraps(factory)
+    def wrapper(*args):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return shared(*args)
+        with _lazy_lock:
+            cache = per_loop.setdefault(loop, {})
+            if args not in cache:
+                cache[args] = factory(*args)
+            return cache[args]
+
+    def cache_clear():
+        shared.cache_clear()
+        per_loop.clear()
+
+    wrapper.cache_clear = cache_clear
+    return wrapper
+
+# Model and sampling parameters used for one pipeline stage
+class ModelRoute(BaseModel):
+    model_config = ConfigDict(frozen=True, protected_namespaces=())
+
+    model: str = Field(..., description="Groq model name")
+    max_tokens: Optional[int] = Field(None, description="Cap on completion tokens (None: provider default)")
+    temperature: Optional[float] = Field(None, description="Sampling temperature (None: client default)")
+    timeout: Optional[float] = Field(None, description="Request timeout in seconds (None: client default)")
+
+LLM_MODEL = os.getenv("LLM_MODEL", "llama3-8b-8192")
+
+def _route_from_env(stage: str, max_tokens: Optional[int] = None, temperature: Optional[float] = None) -> ModelRoute:
+    # <STAGE>_LLM_MODEL / _MAX_TOKENS / _TEMPERATURE / _TIMEOUT override the defaults below
+    def setting(name, cast, default):
+        value = os.getenv(f"{stage.upper()}_LLM_{name}", "")
+        return cast(value) if value else default
+
+    return ModelRoute(
+        model=setting("MODEL", str, LLM_MODEL),
+        max_tokens=setting("MAX_TOKENS", int, max_tokens),
+        temperature=setting("TEMPERATURE", float, temperature),
+        timeout=setting("TIMEOUT", float, None)
+    )
+
+# Classification wants deterministic, bounded output; graph explanations are a short paragraph
+LLM_ROUTES = {
+    "default": ModelRoute(model=LLM_MODEL),
+    "extraction": _route_from_env("extraction", max_tokens=2048, temperature=0.0),
+    "category": _route_from_env("category"),
+    "brand": _route_from_env("brand"),
+    "graph": _route_from_env("graph", max_tokens=512),
+    "graph_batch": _route_from_env("graph_batch", max_tokens=2048),
+    "final": _route_from_env("final", max_tokens=1024),
+}
 
 # Initialize the LLM (ensure GROQ_API_KEY is set in your environment)
-llm = ChatGroq(model="llama3-8b-8192")
+def get_llm(route: Optional[ModelRoute] = None):
+    return _chat_model(route or LLM_ROUTES["default"])
+
+@_memoize_per_loop
+def _chat_model(route: ModelRoute):
+    from langchain_groq import ChatGroq
+    options = {name: value for name, value in route.model_dump(exclude={"model"}).items() if value is not None}
+    return ChatGroq(model=route.model, **options)
 
 class BrandCategoryExtractionOutput(BaseModel):
     productName: str = Field(..., description="Name of the product")
     productBrand: str = Field(..., description="Extracted brand name from the product")
     productCategory: str = Field(..., description="Assigned category for the product")
 
+class BrandCategoryExtractionBatch(BaseModel):
+    products: List[BrandCategoryExtractionOutput] = Field(..., description="Brand and category extracted for each listed product")
+
 class GraphExplanation(BaseModel):
     graph_title: str = Field(..., description="Title of the graph")
     explanation: str = Field(..., description="Explanation of the graph and the relationship between the variables")
 
+class GraphExplanationBatch(BaseModel):
+    explanations: List[GraphExplanation] = Field(..., description="One explanation for each listed graph")
+
 # Pydantic Models for Category-Based Analysis
 class ProductDescription(BaseModel):
     product_name: str = Field(..., description="Name of the product")
@@ -52,22 +171,670 @@ class FinalFinancialAdvice(BaseModel):
     summary: str = Field(..., description="Overall summary of customer's financial habits")
     recommendations: List[str] = Field(..., description="List of actionable financial recommendations")
 
-# Create the structured LLMs
-category_structured_llm = llm.with_structured_output(ProductCategoryDescriptions)
-brand_structured_llm = llm.with_structured_output(BrandDescriptions)
-extraction_structured_llm = llm.with_structured_output(BrandCategoryExtractionOutput)
+# Create the structured LLMs (built once per output schema and route, and per event loop)
+@_memoize_per_loop
+def get_structured_llm(schema, route: Optional[ModelRoute] = None):
+    return get_llm(route).with_structured_output(schema)
+
+def get_stage_llm(stage: str, schema=None):
+    """The runnable for a pipeline stage: its routed chat model, structured when `schema` is given."""
+    route = LLM_ROUTES.get(stage, LLM_ROUTES["default"])
+    return get_structured_llm(schema, route) if schema is not None else get_llm(route)
 
 # Initialize MongoDB Client
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")  # Replace with your MongoDB URI
-client = MongoClient(MONGODB_URI)
-db = client['ecommerce_tracker']  # Replace with your database name
-users_collection = db['users']
-productevents_collection = db['productevents']
 
-# Function to fetch user data and products from MongoDB
-def fetch_user_data(username: str):
+@_memoize
+def get_mongo_client():
+    from pymongo import MongoClient
+    return MongoClient(MONGODB_URI)
+
+def get_database():
+    return get_mongo_client()['ecommerce_tracker']  # Replace with your database name
+
+def get_users_collection():
+    return get_database()['users']
+
+def get_productevents_collection():
+    return get_database()['productevents']
+
+# The clients used to be module attributes; keep those names working, created on first access
+_LAZY_ATTRIBUTES = {
+    "llm": get_llm,
+    "category_structured_llm": lambda: get_stage_llm("category", ProductCategoryDescriptions),
+    "brand_structured_llm": lambda: get_stage_llm("brand", BrandDescriptions),
+    "extraction_structured_llm": lambda: get_stage_llm("extraction", BrandCategoryExtractionOutput),
+    "extraction_batch_structured_llm": lambda: get_stage_llm("extraction", BrandCategoryExtractionBatch),
+    "client": get_mongo_client,
+    "db": get_database,
+    "users_collection": get_users_collection,
+    "productevents_collection": get_productevents_collection,
+}
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class SQLiteTable:
+    """
+    One table of a SQLite file, opened (and created) on first use.
+
+    The stores built on it are optimizations, so SQLite errors never propagate: `execute`
+    returns False and `fetch` None instead, and a file that cannot be opened is not retried.
+    Statements name the table as `{table}`; callers serialize access with their own lock.
+    """
+
+    def __init__(self, path: str, table: str, columns: str, setup=None):
+        self.path = path
+        self.table = table
+        self.columns = columns
+        self.setup = setup
+        self._conn = None
+        self._failed = False
+
+    def connection(self):
+        if self._conn is None and not self._failed:
+            try:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ({self.columns})")
+                if self.setup is not None:
+                    self.setup(conn, self.table)
+                conn.commit()
+                self._conn = conn
+            except sqlite3.Error:
+                self._failed = True
+        return self._conn
+
+    def execute(self, *statements) -> bool:
+        """Runs `(sql, params)` statements in one transaction; False if SQLite failed."""
+        conn = self.connection()
+        if conn is None:
+            return False
+        try:
+            for sql, params in statements:
+                conn.execute(sql.format(table=self.table), params)
+            conn.commit()
+            return True
+        except sqlite3.Error:
+            with contextlib.suppress(sqlite3.Error):
+                conn.rollback()
+            return False
+
+    def fetch(self, sql: str, params=()) -> Optional[list]:
+        """The rows of a query, or None if SQLite failed."""
+        conn = self.connection()
+        if conn is None:
+            return None
+        try:
+            return conn.execute(sql.format(table=self.table), params).fetchall()
+        except sqlite3.Error:
+            return None
+
+# Persistent key/value cache used to avoid repeating LLM work across report runs
+class PersistentLRUCache:
+    """
+    A SQLite-backed key/value store with an in-memory LRU in front of it.
+
+    Values are stored as JSON. The on-disk table is capped at `max_entries` rows
+    (least recently used rows are evicted first) and the in-memory layer at
+    `memory_entries` items. When `ttl` (seconds) is set, entries older than that
+    are treated as missing. Hit/miss counters cover both layers.
+    """
+
+    # Eviction runs once per this many disk writes
+    EVICTION_INTERVAL = 100
+    # Access times of served keys are written in batches (of EVICTION_INTERVAL keys), at least
+    # this often and always before evicting, so keys read from memory stay recent on disk too
+    ACCESS_FLUSH_SECONDS = 60.0
+
+    def __init__(self, path: str, table: str, max_entries: int = 50000, memory_entries: int = 2048, ttl: Optional[float] = None):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()
+        self._db = SQLiteTable(
+            path, table, "key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed REAL NOT NULL, stored REAL NOT NULL DEFAULT 0",
+            setup=self._migrate
+        )
+        self._writes_since_eviction = 0
+        self._accessed = {}
+        self._accessed_flushed = time.time()
+
+    @staticmethod
+    def _migrate(conn, table):
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if "stored" not in columns:
+            # Cache files created before entries carried a write time
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN stored REAL NOT NULL DEFAULT 0")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)")
+
+    def _remember(self, key, value, stored):
+        self._memory[key] = (value, stored)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _expired(self, stored) -> bool:
+        return self.ttl is not None and time.time() - stored > self.ttl
+
+    def _touch(self, key):
+        now = time.time()
+        self._accessed[key] = now
+        if len(self._accessed) >= self.EVICTION_INTERVAL or now - self._accessed_flushed >= self.ACCESS_FLUSH_SECONDS:
+            self._flush_accessed()
+
+    def _flush_accessed(self):
+        self._accessed_flushed = time.time()
+        if self._accessed:
+            self._db.execute(*(
+                ("UPDATE {table} SET accessed = ? WHERE key = ?", (accessed, key)) for key, accessed in self._accessed.items()
+            ))
+            self._accessed.clear()
+
+    def get(self, key: str):
+        with self._lock:
+            if key in self._memory:
+                value, stored = self._memory[key]
+                if not self._expired(stored):
+                    self._memory.move_to_end(key)
+                    self._touch(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+            rows = self._db.fetch("SELECT value, stored FROM {table} WHERE key = ?", (key,))
+            if not rows or self._expired(rows[0][1]):
+                self.misses += 1
+                return None
+            self._touch(key)
+            value = json.loads(rows[0][0])
+            self._remember(key, value, rows[0][1])
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            now = time.time()
+            self._remember(key, value, now)
+            self._accessed.pop(key, None)
+            # The cache is an optimization only; a broken disk layer must never fail a report
+            stored = self._db.execute((
+                "INSERT OR REPLACE INTO {table} (key, value, accessed, stored) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now)
+            ))
+            if stored:
+                self._writes_since_eviction += 1
+                if self._writes_since_eviction >= self.EVICTION_INTERVAL:
+                    self._evict()
+
+    def _evict(self):
+        self._writes_since_eviction = 0
+        self._flush_accessed()
+        statements = []
+        if self.ttl is not None:
+            statements.append(("DELETE FROM {table} WHERE stored < ?", (time.time() - self.ttl,)))
+        statements.append((
+            "DELETE FROM {table} WHERE key NOT IN (SELECT key FROM {table} ORDER BY accessed DESC LIMIT ?)",
+            (self.max_entries,)
+        ))
+        self._db.execute(*statements)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "memory_entries": len(self._memory)
+        }
+
+# Brand/category extraction cache, keyed by normalized product title
+EXTRACTION_CACHE_PATH = os.getenv(
+    "EXTRACTION_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "extraction_cache.sqlite3")
+)
+extraction_cache = PersistentLRUCache(
+    EXTRACTION_CACHE_PATH,
+    "brand_category_extractions",
+    max_entries=int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "50000")),
+    memory_entries=int(os.getenv("EXTRACTION_CACHE_MEMORY_ENTRIES", "2048"))
+)
+
+def normalize_product_title(title: str) -> str:
+    return re.sub(r"\s+", " ", (title or "").strip().lower())
+
+# Finished reports, keyed by a fingerprint of the user's inputs (REPORT_CACHE_TTL_SECONDS=0 disables it)
+REPORT_CACHE_PATH = os.getenv(
+    "REPORT_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "report_cache.sqlite3")
+)
+REPORT_CACHE_TTL_SECONDS = float(os.getenv("REPORT_CACHE_TTL_SECONDS", "86400"))
+report_cache = PersistentLRUCache(
+    REPORT_CACHE_PATH,
+    "reports",
+    max_entries=int(os.getenv("REPORT_CACHE_MAX_ENTRIES", "1000")),
+    memory_entries=int(os.getenv("REPORT_CACHE_MEMORY_ENTRIES", "128")),
+    ttl=REPORT_CACHE_TTL_SECONDS
+)
+
+# Results of individual report stages, keyed by a hash of their inputs (STAGE_CACHE_TTL_SECONDS=0 disables it)
+STAGE_CACHE_TTL_SECONDS = float(os.getenv("STAGE_CACHE_TTL_SECONDS", "604800"))
+# Bump when prompts or stage logic change so cached stage results are not reused
+STAGE_CACHE_VERSION = "1"
+stage_cache = PersistentLRUCache(
+    REPORT_CACHE_PATH,
+    "stage_results",
+    max_entries=int(os.getenv("STAGE_CACHE_MAX_ENTRIES", "5000")),
+    memory_entries=int(os.getenv("STAGE_CACHE_MEMORY_ENTRIES", "256")),
+    ttl=STAGE_CACHE_TTL_SECONDS
+)
+
+# Number of products classified per batched extraction call (0 or 1 disables batching)
+EXTRACTION_BATCH_SIZE = int(os.getenv("EXTRACTION_BATCH_SIZE", "25"))
+
+# Retry policy shared by every LLM call site
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, capped at `max_attempts` attempts per call.
+    """
+
+    def __init__(self, max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+RETRY_POLICIES = {
+    stage: RetryPolicy(
+        max_attempts=int(os.getenv(f"{stage.upper()}_MAX_ATTEMPTS", str(default_attempts))),
+        base_delay=LLM_RETRY_BASE_DELAY,
+        max_delay=LLM_RETRY_MAX_DELAY
+    )
+    for stage, default_attempts in (
+        ("extraction", 3),
+        ("category", 4),
+        ("brand", 4),
+        ("graph", 4),
+        ("final", 4)
+    )
+}
+
+# Overall wall-clock budget for the LLM stages of a single report
+REPORT_TIME_BUDGET_SECONDS = float(os.getenv("REPORT_TIME_BUDGET_SECONDS", "180"))
+
+# HTTP statuses and exception names worth another attempt (rate limits, timeouts, outages, bad output)
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = {
+    "RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError",
+    "OutputParserException", "ValidationError", "JSONDecodeError"
+}
+
+class LLMStageError(Exception):
+    """Raised when an LLM stage gives up: a non-retryable error, attempts exhausted, or budget spent."""
+
+    def __init__(self, stage: str, reason: str, attempts: int):
+        super().__init__(f"{stage} stage failed after {attempts} attempt(s): {reason}")
+        self.stage = stage
+        self.reason = reason
+        self.attempts = attempts
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"stage": self.stage, "reason": self.reason, "attempts": self.attempts}
+
+class ReportBudget:
+    """Tracks the time left for a report and the stage failures that occurred while producing it."""
+
+    def __init__(self, seconds: float = REPORT_TIME_BUDGET_SECONDS):
+        self.deadline = time.monotonic() + seconds
+        self.failures = []
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def record_failure(self, error: LLMStageError) -> None:
+        self.failures.append(error)
+
+def is_retryable_error(error: Exception) -> bool:
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status_code, int):
+        return status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (TimeoutError, ConnectionError)) or type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+def _retry_delay(stage: str, attempt: int, reason: str, error: Optional[Exception], budget: Optional[ReportBudget]) -> float:
+    # Either returns how long to wait before the next attempt or raises LLMStageError
+    if error is not None and not is_retryable_error(error):
+        raise LLMStageError(stage, reason, attempt) from error
+    policy = RETRY_POLICIES[stage]
+    if attempt >= policy.max_attempts:
+        raise LLMStageError(stage, reason, attempt) from error
+    delay = policy.backoff(attempt)
+    if budget is not None:
+        if budget.remaining() <= delay:
+            raise LLMStageError(stage, f"report time budget exhausted ({reason})", attempt) from error
+    return delay
+
+# Shared rate limiter for every LLM call (Groq enforces requests- and tokens-per-minute limits)
+class TokenBucket:
+    """
+    A token bucket refilled continuously at `capacity` tokens per minute.
+
+    `reserve` deducts the tokens immediately (the balance may go negative) and returns how long
+    the caller must wait before using them, so concurrent callers queue up fairly whether they
+    wait in threads or in asyncio tasks.
+    """
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.rate = capacity / 60.0
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+    def release(self, amount: float) -> None:
+        # Returns a reservation that will not be used
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + min(amount, self.capacity))
+
+class RateLimiter:
+    """Gates LLM calls on a requests-per-minute and a tokens-per-minute bucket (0 disables a bucket)."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+
+    def reserve(self, estimated_tokens: int, max_wait: Optional[float] = None) -> float:
+        """
+        Reserves capacity for one call and returns the wait before it may be sent. If that wait
+        exceeds `max_wait`, nothing is reserved (the caller is expected to give up).
+        """
+        waits = [0.0]
+        if self.requests is not None:
+            waits.append(self.requests.reserve(1))
+        if self.tokens is not None:
+            waits.append(self.tokens.reserve(estimated_tokens))
+        wait_seconds = max(waits)
+        if max_wait is not None and wait_seconds > max_wait:
+            if self.requests is not None:
+                self.requests.release(1)
+            if self.tokens is not None:
+                self.tokens.release(estimated_tokens)
+        return wait_seconds
+
+    def acquire(self, estimated_tokens: int) -> float:
+        wait_seconds = self.reserve(estimated_tokens)
+        if wait_seconds:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+    async def aacquire(self, estimated_tokens: int) -> float:
+        wait_seconds = self.reserve(estimated_tokens)
+        if wait_seconds:
+            await asyncio.sleep(wait_seconds)
+        return wait_seconds
+
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "30"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "30000"))
+# Completion tokens assumed per call when estimating a request's token cost
+LLM_COMPLETION_TOKEN_ESTIMATE = int(os.getenv("LLM_COMPLETION_TOKEN_ESTIMATE", "512"))
+rate_limiter = RateLimiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+
+def estimate_request_tokens(prompt: str) -> int:
+    return estimate_tokens(prompt) + LLM_COMPLETION_TOKEN_ESTIMATE
+
+def _rate_limit_wait(stage: str, prompt: str, attempt: int, budget: Optional[ReportBudget]) -> float:
+    # Reserves capacity for one call and returns how long to wait before sending it; a call the
+    # budget can't wait for gives up without holding capacity other callers need
+    max_wait = budget.remaining() if budget is not None else None
+    wait_seconds = rate_limiter.reserve(estimate_request_tokens(prompt), max_wait)
+    if max_wait is not None and wait_seconds > max_wait:
+        raise LLMStageError(stage, "report time budget exhausted waiting for rate limit capacity", attempt - 1)
+    return wait_seconds
+
+# Instrumentation: per-stage spans with wall time, LLM calls, retries and token counts
+REPORT_METRICS = os.getenv("REPORT_METRICS", "false").lower() in ("1", "true", "yes")
+# Prometheus text-format file rewritten after every report (empty disables it)
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+
+class MetricsSpan:
+    """Counters for one pipeline stage; safe to update from several threads."""
+
+    FIELDS = (
+        "wall_seconds", "llm_calls", "retries", "prompt_tokens", "completion_tokens",
+        "estimated_prompt_tokens", "rate_limit_wait_seconds", "products_dropped_from_prompts"
+    )
+
+    def __init__(self, name: str):
+        self.name = name
+        self.values = dict.fromkeys(self.FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, **amounts) -> None:
+        with self._lock:
+            for field, amount in amounts.items():
+                self.values[field] += amount
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.values)
+
+# The span LLM calls are attributed to; asyncio tasks and asyncio.to_thread inherit it
+_current_span = contextvars.ContextVar("ai_agents_current_span", default=None)
+
+def _instrumented_caches():
+    return {"extraction": extraction_cache, "report": report_cache, "stage": stage_cache}
+
+class ReportMetrics:
+    """Spans and cache activity of one report."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = OrderedDict()
+        self._lock = threading.Lock()
+        self._cache_baseline = {name: (cache.hits, cache.misses) for name, cache in _instrumented_caches().items()}
+
+    def span_for(self, name: str) -> MetricsSpan:
+        with self._lock:
+            if name not in self.spans:
+                self.spans[name] = MetricsSpan(name)
+            return self.spans[name]
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        span = self.span_for(name)
+        token = _current_span.set(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.add(wall_seconds=time.perf_counter() - started)
+            _current_span.reset(token)
+
+    def summary(self) -> Dict[str, Any]:
+        spans = {name: span.to_dict() for name, span in self.spans.items()}
+        caches = {}
+        # Counters are process-wide, so concurrent reports can blur each other's cache deltas
+        for name, cache in _instrumented_caches().items():
+            base_hits, base_misses = self._cache_baseline.get(name, (0, 0))
+            hits, misses = cache.hits - base_hits, cache.misses - base_misses
+            caches[name] = {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+        totals = {
+            field: sum(span[field] for span in spans.values())
+            for field in ("llm_calls", "retries", "prompt_tokens", "completion_tokens", "estimated_prompt_tokens")
+        }
+        return dict(total_seconds=time.perf_counter() - self.started, **totals, spans=spans, caches=caches)
+
+def _record_llm_attempt(prompt: str, attempt: int, wait_seconds: float) -> None:
+    span = _current_span.get()
+    if span is not None:
+        span.add(
+            llm_calls=1,
+            retries=1 if attempt > 1 else 0,
+            estimated_prompt_tokens=estimate_tokens(prompt),
+            rate_limit_wait_seconds=wait_seconds
+        )
+
+@_memoize
+def _token_usage_callback_class():
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class TokenUsageCallback(BaseCallbackHandler):
+        """Adds the provider-reported token usage of each LLM response to a span."""
+
+        run_inline = True
+
+        def __init__(self, span: MetricsSpan):
+            self.span = span
+
+        def on_llm_end(self, response, **kwargs):
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+            if not usage:
+                for generations in response.generations:
+                    for generation in generations:
+                        metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                        prompt_tokens += metadata.get("input_tokens", 0)
+                        completion_tokens += metadata.get("output_tokens", 0)
+            self.span.add(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    return TokenUsageCallback
+
+def _llm_run_config():
+    # Only instrumented calls pay for the callback
+    span = _current_span.get()
+    if span is None:
+        return None
+    return {"callbacks": [_token_usage_callback_class()(span)]}
+
+def invoke_with_retry(stage: str, runnable, prompt: str, budget: Optional[ReportBudget] = None):
+    """
+    Invokes `runnable` with `prompt`, retrying retryable errors and empty responses
+    according to the stage's RetryPolicy and the report budget. Every attempt first
+    waits for capacity from the shared `rate_limiter`.
+
+    Raises:
+        LLMStageError: When the stage gives up.
+    """
+    attempt = 0
+    while True:
+        if budget is not None and budget.expired():
+            raise LLMStageError(stage, "report time budget exhausted", attempt)
+        attempt += 1
+        error = None
+        wait_seconds = _rate_limit_wait(stage, prompt, attempt, budget)
+        if wait_seconds:
+            time.sleep(wait_seconds)
+        _record_llm_attempt(prompt, attempt, wait_seconds)
+        try:
+            result = runnable.invoke(prompt, config=_llm_run_config())
+            if result:
+                return result
+            reason = "empty or unparseable response"
+        except Exception as e:
+            error = e
+            reason = f"{type(e).__name__}: {e}"
+        time.sleep(_retry_delay(stage, attempt, reason, error, budget))
+
+# Semaphore bounding the current report's LLM calls in flight (set by `_alimited`)
+_llm_slots = contextvars.ContextVar("llm_slots", default=None)
+
+async def ainvoke_with_retry(stage: str, runnable, prompt: str, budget: Optional[ReportBudget] = None):
+    """
+    Async counterpart of `invoke_with_retry`; each attempt is also bounded by the remaining
+    budget and holds a slot of the report's LLM semaphore, if any, while it runs.
+    """
+    attempt = 0
+    while True:
+        if budget is not None and budget.expired():
+            raise LLMStageError(stage, "report time budget exhausted", attempt)
+        attempt += 1
+        error = None
+        wait_seconds = _rate_limit_wait(stage, prompt, attempt, budget)
+        if wait_seconds:
+            await asyncio.sleep(wait_seconds)
+        _record_llm_attempt(prompt, attempt, wait_seconds)
+        try:
+            async with _llm_slots.get() or contextlib.nullcontext():
+                if budget is not None:
+                    result = await asyncio.wait_for(runnable.ainvoke(prompt, config=_llm_run_config()), timeout=budget.remaining())
+                else:
+                    result = await runnable.ainvoke(prompt, config=_llm_run_config())
+            if result:
+                return result
+            reason = "empty or unparseable response"
+        except Exception as e:
+            error = e
+            reason = f"{type(e).__name__}: {e}"
+        await asyncio.sleep(_retry_delay(stage, attempt, reason, error, budget))
+
+# Aggregate product events inside MongoDB instead of streaming every document to Python
+MONGO_PUSHDOWN = os.getenv("MONGO_PUSHDOWN", "false").lower() in ("1", "true", "yes")
+
+# Only the event fields the report needs
+PRODUCT_EVENT_PROJECTION = {'_id': 0, 'platform': 1, 'productTitle': 1, 'price': 1, 'productUrl': 1, 'timestamp': 1}
+
+# Collapse repeated events of the same product before extraction and prompting
+DEDUPE_PRODUCT_EVENTS = os.getenv("DEDUPE_PRODUCT_EVENTS", "true").lower() in ("1", "true", "yes")
+
+def _grouped_product_events_pipeline(user_id):
+    # Categories and brands are assigned by the LLM and are not stored in MongoDB, so events are
+    # grouped per product (non-empty URL, or exact title when there is none) and platform: the
+    # finest key any graph needs. Titles that differ only in case or spacing form separate groups
+    # here and are merged by `_listing_key` in `fetch_products`, since MongoDB cannot collapse
+    # whitespace the way `normalize_product_title` does. Every purchase price is kept so per-site,
+    # per-category and count aggregates computed from the groups stay exact.
+    has_url = {'$gt': ['$productUrl', '']}
+    return [
+        {'$match': {'userId': user_id}},
+        {'$sort': {'timestamp': 1}},
+        {'$group': {
+            '_id': {
+                'platform': {'$ifNull': ['$platform', '']},
+                'url': {'$cond': [has_url, '$productUrl', None]},
+                'title': {'$cond': [has_url, None, {'$ifNull': ['$productTitle', '']}]}
+            },
+            'productTitle': {'$first': {'$ifNull': ['$productTitle', '']}},
+            'productUrl': {'$first': '$productUrl'},
+            'prices': {'$push': {'$ifNull': ['$price', 0]}},
+            'total': {'$sum': {'$ifNull': ['$price', 0]}},
+            'firstSeen': {'$min': '$timestamp'},
+            'lastSeen': {'$max': '$timestamp'}
+        }},
+        # Groups merged afterwards then list their prices in event order
+        {'$sort': {'firstSeen': 1}}
+    ]
+
+def fetch_user(username: str):
+    """
+    Fetches the user's id and the goals/budget used in every prompt.
+
+    Raises:
+        ValueError: If no user has this username.
+    """
     # Fetch user document by username
-    user = users_collection.find_one({'username': username})
+    user = get_users_collection().find_one({'username': username}, {'goals': 1, 'budget': 1})
     if not user:
         raise ValueError(f"User '{username}' not found.")
 
@@ -75,33 +842,963 @@ def fetch_user_data(username: str):
         'goals': user.get('goals', []),
         'budget': user.get('budget', 0)
     }
+    return user['_id'], user_info
+
+def _product_from_event(event):
+    return {
+        'ecommerceSite': event.get('platform', ''),
+        'productName': event.get('productTitle', ''),
+        'productPrice': event.get('price', 0),
+        'productPurchased': True,  # Assuming all events are purchases; modify if needed
+        'productUrl': event.get('productUrl'),
+        'viewCount': 1,
+        'firstSeen': event.get('timestamp'),
+        'lastSeen': event.get('timestamp')
+    }
+
+def _listing_key(site, name, url):
+    # The URL identifies a listing; without one, fall back to the normalized title. The site is
+    # always part of the key so per-site spending stays exact.
+    if url:
+        return ('url', site, url)
+    return ('title', site, normalize_product_title(name))
+
+def _product_key(product):
+    return _listing_key(product['ecommerceSite'], product['productName'], product.get('productUrl'))
+
+def dedupe_product_events(products):
+    """
+    Collapses products that are the same listing into one entry per site and `productUrl` (or
+    normalized title when there is no URL).
+
+    Each entry keeps every purchase price in 'priceHistory' (so aggregates stay exact, see
+    `_purchase_prices`), the summed 'viewCount' and the 'firstSeen'/'lastSeen' timestamps;
+    'productPrice' becomes the average purchase price. Other fields come from the first entry.
+    """
+    merged = OrderedDict()
+    for product in products:
+        key = _product_key(product)
+        prices = list(_purchase_prices(product)) if product['productPurchased'] else []
+        entry = merged.get(key)
+        if entry is None:
+            entry = merged[key] = dict(product, priceHistory=prices, viewCount=product.get('viewCount', 1))
+            continue
+        entry['priceHistory'].extend(prices)
+        entry['viewCount'] += product.get('viewCount', 1)
+        entry['productPurchased'] = entry['productPurchased'] or product['productPurchased']
+        for field, pick in (('firstSeen', min), ('lastSeen', max)):
+            seen = [value for value in (entry.get(field), product.get(field)) if value is not None]
+            entry[field] = pick(seen) if seen else None
+    for entry in merged.values():
+        history = entry['priceHistory']
+        entry['productPrice'] = sum(history) / len(history) if history else entry['productPrice']
+    return list(merged.values())
+
+# Hold fetched products in a columnar ProductTable instead of one dictionary per event
+COLUMNAR_PRODUCTS = os.getenv("COLUMNAR_PRODUCTS", "true").lower() in ("1", "true", "yes")
+
+# Fields of a fetched product, in the order product dictionaries list them
+PRODUCT_FIELDS = ('ecommerceSite', 'productName', 'productPrice', 'productPurchased', 'productUrl',
+                  'viewCount', 'firstSeen', 'lastSeen', 'priceHistory')
+
+# Fields stored as dictionary-encoded integer codes (-1: not assigned yet)
+CODED_PRODUCT_FIELDS = ('ecommerceSite', 'productBrand', 'productCategory')
+
+class _Labels:
+    """Dictionary encoding of one string column: label <-> integer code."""
+    __slots__ = ("values", "codes")
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+class ProductRecord(MutableMapping):
+    """
+    Dictionary-like view of one row of a `ProductTable`.
+
+    Reads come from the table's columns; assigning 'productBrand' or 'productCategory' stores
+    the encoded label, other assigned fields are kept per row. Unassigned brand and category
+    are missing keys, as in a product dictionary before extraction.
+    """
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index: int):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, field):
+        return self.table.get_value(self.index, field)
+
+    def __setitem__(self, field, value):
+        self.table.set_value(self.index, field, value)
+
+    def __delitem__(self, field):
+        self.table.delete_value(self.index, field)
+
+    def __iter__(self):
+        return iter(self.table.fields(self.index))
+
+    def __len__(self):
+        return len(self.table.fields(self.index))
+
+    def __repr__(self):
+        return f"ProductRecord({dict(self)!r})"
+
+    def to_json(self):
+        return dict(self)
+
+class ProductTable:
+    """
+    Columnar container of a user's products, one row per listing (see `_listing_key`).
+
+    Site, brand and category are dictionary-encoded integer codes, the other per-product
+    fields are plain columns, and every purchase price sits in the typed `prices` array with
+    the owning row in `price_rows`. Iterating yields `ProductRecord` views, so code written
+    for product dictionaries (including `dedupe_product_events` output, which a table
+    matches field for field) keeps working; `aggregate_graph_datasets` runs its group-bys
+    over the columns directly.
+    """
+    def __init__(self):
+        self.labels = {field: _Labels() for field in CODED_PRODUCT_FIELDS}
+        self.codes = {field: array.array('i') for field in CODED_PRODUCT_FIELDS}
+        self.names = []
+        self.urls = []
+        self.list_prices = array.array('d')
+        self.purchased = array.array('b')
+        self.view_counts = array.array('q')
+        self.first_seen = []
+        self.last_seen = []
+        self.prices = array.array('d')
+        self.price_rows = array.array('i')
+        self.extras = {}
+        self._rows = {}
+        self._histories = None
+
+    @classmethod
+    def from_events(cls, events):
+        """Builds a table from product event documents, merging repeated events of a listing."""
+        table = cls()
+        for event in events:
+            timestamp = event.get('timestamp')
+            table.add(event.get('platform', ''), event.get('productTitle', ''), event.get('productUrl'),
+                      [event.get('price', 0)], first_seen=timestamp, last_seen=timestamp)
+        return table
+
+    def add(self, site, name, url, prices, purchased: bool = True, view_count: int = 1,
+            first_seen=None, last_seen=None) -> int:
+        """
+        Adds product entries to the row of their listing, creating it on first sight.
+
+        `prices` are this entry's prices; they are recorded as purchases when `purchased`,
+        otherwise only the first one is kept as the listed price.
+
+        Returns:
+            int: The row index.
+        """
+        key = _listing_key(site, name, url)
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = len(self.names)
+            self.codes['ecommerceSite'].append(self.labels['ecommerceSite'].encode(site))
+            self.codes['productBrand'].append(-1)
+            self.codes['productCategory'].append(-1)
+            self.names.append(name)
+            self.urls.append(url)
+            self.list_prices.append(prices[0] if prices else 0)
+            self.purchased.append(purchased)
+            self.view_counts.append(view_count)
+            self.first_seen.append(first_seen)
+            self.last_seen.append(last_seen)
+        else:
+            self.purchased[row] = self.purchased[row] or purchased
+            self.view_counts[row] += view_count
+            for column, value, pick in ((self.first_seen, first_seen, min), (self.last_seen, last_seen, max)):
+                if value is not None:
+                    column[row] = value if column[row] is None else pick(column[row], value)
+        if purchased:
+            self.prices.extend(prices)
+            self.price_rows.extend([row] * len(prices))
+            self._histories = None
+        return row
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return (ProductRecord(self, row) for row in range(len(self.names)))
+
+    def __getitem__(self, row: int) -> ProductRecord:
+        if not -len(self.names) <= row < len(self.names):
+            raise IndexError(row)
+        return ProductRecord(self, row % len(self.names))
+
+    def __repr__(self):
+        return f"ProductTable({len(self.names)} products, {len(self.prices)} purchases)"
+
+    def price_histories(self) -> List[List[float]]:
+        """The purchase prices of every row (built once per set of purchases)."""
+        if self._histories is None:
+            histories = [[] for _ in self.names]
+            for row, price in zip(self.price_rows, self.prices):
+                histories[row].append(price)
+            self._histories = histories
+        return self._histories
+
+    def fields(self, row: int) -> List[str]:
+        present = list(PRODUCT_FIELDS)
+        present.extend(field for field in ('productBrand', 'productCategory') if self.codes[field][row] >= 0)
+        present.extend(field for field in self.extras.get(row, ()) if field not in present)
+        return present
+
+    def get_value(self, row: int, field):
+        if field in self.codes:
+            code = self.codes[field][row]
+            if code < 0:
+                raise KeyError(field)
+            return self.labels[field].values[code]
+        extras = self.extras.get(row)
+        if extras and field in extras:
+            return extras[field]
+        if field == 'productName':
+            return self.names[row]
+        if field == 'productUrl':
+            return self.urls[row]
+        if field == 'productPurchased':
+            return bool(self.purchased[row])
+        if field == 'viewCount':
+            return self.view_counts[row]
+        if field == 'firstSeen':
+            return self.first_seen[row]
+        if field == 'lastSeen':
+            return self.last_seen[row]
+        if field == 'priceHistory':
+            return list(self.price_histories()[row])
+        if field == 'productPrice':
+            history = self.price_histories()[row]
+            return sum(history) / len(history) if history else self.list_prices[row]
+        raise KeyError(field)
+
+    def set_value(self, row: int, field, value):
+        if field in self.codes:
+            self.codes[field][row] = self.labels[field].encode(value)
+        else:
+            self.extras.setdefault(row, {})[field] = value
+
+    def delete_value(self, row: int, field):
+        if field in ('productBrand', 'productCategory') and self.codes[field][row] >= 0:
+            self.codes[field][row] = -1
+        elif field in self.extras.get(row, ()):
+            del self.extras[row][field]
+        else:
+            raise KeyError(field)
+
+    def to_json(self):
+        return [dict(record) for record in self]
+
+def fetch_products(user_id, pushdown: bool = MONGO_PUSHDOWN, dedupe: bool = DEDUPE_PRODUCT_EVENTS,
+                   columnar: bool = COLUMNAR_PRODUCTS):
+    """
+    Fetches a user's product events as product dictionaries.
+
+    With `pushdown` (grouped in MongoDB) or `dedupe` (grouped here, see `dedupe_product_events`),
+    repeated events of a product become one entry whose 'priceHistory' lists every purchase
+    price ('productPrice' is the average), so the aggregation helpers still count every purchase.
+    With `columnar` as well, the grouped products are returned as a `ProductTable` built while
+    streaming the events, so no dictionary is created per event.
+    """
+    if pushdown:
+        groups = get_productevents_collection().aggregate(_grouped_product_events_pipeline(user_id))
+        if columnar:
+            table = ProductTable()
+            for group in groups:
+                table.add(group['_id']['platform'], group['productTitle'], group.get('productUrl'), group['prices'],
+                          view_count=len(group['prices']), first_seen=group.get('firstSeen'), last_seen=group.get('lastSeen'))
+            return table
+        products = []
+        for group in groups:
+            products.append({
+                'ecommerceSite': group['_id']['platform'],
+                'productName': group['productTitle'],
+                'productPrice': group['total'] / len(group['prices']),
+                'productPurchased': True,
+                'productUrl': group.get('productUrl'),
+                'priceHistory': group['prices'],
+                'viewCount': len(group['prices']),
+                'firstSeen': group.get('firstSeen'),
+                'lastSeen': group.get('lastSeen')
+            })
+        return dedupe_product_events(products)
 
     # Fetch product events for the user
-    product_events = productevents_collection.find({'userId': user['_id']})
+    product_events = get_productevents_collection().find({'userId': user_id}, PRODUCT_EVENT_PROJECTION)
+    if columnar and dedupe:
+        return ProductTable.from_events(product_events)
+    products = [_product_from_event(event) for event in product_events]
+    return dedupe_product_events(products) if dedupe else products
+
+# Function to fetch user data and products from MongoDB
+def fetch_user_data(username: str, pushdown: bool = MONGO_PUSHDOWN):
+    user_id, user_info = fetch_user(username)
+    return user_info, fetch_products(user_id, pushdown)
+
+def compute_report_fingerprint(user_id, user_info, events) -> str:
+    """Content hash of the user's goals/budget and the set of (event id, price) pairs."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'user': str(user_id), 'info': user_info}, sort_keys=True, default=str).encode())
+    for event_id, price in sorted((str(event['_id']), event.get('price', 0)) for event in events):
+        digest.update(f"{event_id}:{price!r}\n".encode())
+    return digest.hexdigest()
+
+def fetch_report_fingerprint(user_id, user_info) -> str:
+    events = get_productevents_collection().find({'userId': user_id}, {'_id': 1, 'price': 1})
+    return compute_report_fingerprint(user_id, user_info, events)
+
+def _new_events_query(user_id, checkpoint):
+    query = {'userId': user_id}
+    if checkpoint:
+        # (timestamp, _id) ordering, so events sharing the checkpoint's timestamp are not skipped
+        query['$or'] = [
+            {'timestamp': {'$gt': checkpoint['timestamp']}},
+            {'timestamp': checkpoint['timestamp'], '_id': {'$gt': checkpoint['eventId']}}
+        ]
+    return query
+
+def fetch_new_product_events(user_id, checkpoint: Optional[Dict[str, Any]] = None):
+    """
+    Fetches the user's product events that come after `checkpoint`, oldest first.
+
+    Args:
+        user_id: The user's MongoDB id.
+        checkpoint (dict, optional): {'timestamp', 'eventId'} of the last processed event.
+
+    Returns:
+        tuple: (products, checkpoint) where checkpoint identifies the newest event fetched
+        (or is the given checkpoint when there are no new events).
+    """
+    query = _new_events_query(user_id, checkpoint)
+    projection = {'platform': 1, 'productTitle': 1, 'price': 1, 'productUrl': 1, 'timestamp': 1}
+    product_events = get_productevents_collection().find(query, projection).sort([('timestamp', 1), ('_id', 1)])
+
     products = []
     for event in product_events:
-        product = {
-            'ecommerceSite': event.get('platform', ''),
-            'productName': event.get('productTitle', ''),
-            'productPrice': event.get('price', 0),
-            'productPurchased': True  # Assuming all events are purchases; modify if needed
-        }
-        products.append(product)
+        products.append(_product_from_event(event))
+        checkpoint = {'timestamp': event.get('timestamp'), 'eventId': event['_id']}
+    return products, checkpoint
+
+# Canonical brand and category names: near-duplicates ("Electronic", "electronics ") share one group
+CATEGORY_FUZZY_THRESHOLD = float(os.getenv("CATEGORY_FUZZY_THRESHOLD", "0.88"))
+# Brands are short and distinct names are often close ("Sony"/"Sonos"), so they need a closer match
+BRAND_FUZZY_THRESHOLD = float(os.getenv("BRAND_FUZZY_THRESHOLD", "0.93"))
+# A fuzzy match must also pair up word for word, each pair this close ("Jewelery"/"Jewelry"), so an
+# added or swapped word ("Women's Clothing"/"Men's Clothing") never merges however close the whole
+_SPELLING_VARIANT_RATIO = 0.8
+
+# Category names the LLM uses interchangeably, by normalized key (see `canonical_key`)
+CATEGORY_SYNONYMS = {
+    "electronic device": "electronic",
+    "consumer electronic": "electronic",
+    "tech": "electronic",
+    "technology": "electronic",
+    "gadget": "electronic",
+    "clothing": "apparel",
+    "clothe": "apparel",
+    "fashion": "apparel",
+    "shoe": "footwear",
+    "appliance": "home appliance",
+    "kitchen appliance": "home appliance",
+    "household appliance": "home appliance",
+    "cosmetic": "beauty",
+    "skincare": "beauty",
+    "skin care": "beauty",
+    "makeup": "beauty",
+    "game": "video game",
+    "gaming": "video game",
+    "outdoor": "sport outdoor",
+    "sport": "sport outdoor",
+    "sporting good": "sport outdoor",
+    "toy game": "toy",
+    "grocery": "grocerie",
+    "food": "grocerie",
+    "pet": "pet supplie",
+    "tool": "tool home improvement",
+    "home improvement": "tool home improvement",
+}
+
+def _singular(token: str) -> str:
+    if len(token) > 3 and token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        return token[:-1]
+    return token
+
+def canonical_key(name: str) -> str:
+    """Case-, spacing-, punctuation- and plural-insensitive lookup key ("&" and "and" are dropped)."""
+    tokens = re.findall(r"[a-z0-9]+", (name or "").lower().replace("'", ""))
+    return " ".join(_singular(token) for token in tokens if token != "and")
+
+def _spelling_variants(key: str, other: str) -> bool:
+    """True when two canonical keys have the same words, differing only in their spelling."""
+    words, others = key.split(), other.split()
+    if len(words) != len(others):
+        return False
+    return all(
+        word == candidate
+        or (word[0] == candidate[0] and difflib.SequenceMatcher(None, word, candidate).ratio() >= _SPELLING_VARIANT_RATIO)
+        for word, candidate in zip(words, others)
+    )
+
+class CanonicalAliasStore:
+    """
+    Aliases (normalized variant -> canonical name) learned from fuzzy and synonym merges,
+    persisted in SQLite so every run groups the same variants the same way.
+    """
 
-    return user_info, products
+    def __init__(self, path: str, table: str = "canonical_aliases"):
+        self.path = path
+        self.table = table
+        self._lock = threading.RLock()
+        self._db = SQLiteTable(path, table, "kind TEXT NOT NULL, alias TEXT NOT NULL, canonical TEXT NOT NULL, PRIMARY KEY (kind, alias)")
+        self._aliases = None
+
+    def _load(self):
+        if self._aliases is None:
+            rows = self._db.fetch("SELECT kind, alias, canonical FROM {table}") or []
+            self._aliases = {(kind, alias): canonical for kind, alias, canonical in rows}
+        return self._aliases
+
+    def get(self, kind: str, alias: str) -> Optional[str]:
+        with self._lock:
+            return self._load().get((kind, alias))
+
+    def set(self, kind: str, alias: str, canonical: str) -> None:
+        with self._lock:
+            aliases = self._load()
+            if aliases.get((kind, alias)) == canonical:
+                return
+            aliases[(kind, alias)] = canonical
+            self._db.execute(("INSERT OR REPLACE INTO {table} (kind, alias, canonical) VALUES (?, ?, ?)", (kind, alias, canonical)))
+
+canonical_aliases = CanonicalAliasStore(EXTRACTION_CACHE_PATH)
+
+class CanonicalNames(list):
+    """
+    The list of brand or category names used in a run, with a hash index for O(1) lookups.
+
+    `resolve` maps a name to the existing entry with the same `canonical_key`, a persisted alias,
+    a synonym (categories) or the closest fuzzy match above the kind's threshold whose words
+    differ only in spelling, and appends it when nothing matches. Being a list, it can be passed anywhere the plain lists went.
+    """
 
-def extract_brand_and_category(product, categories, brands):
+    def __init__(self, kind: str, names=(), aliases: Optional[CanonicalAliasStore] = None):
+        super().__init__()
+        self.kind = kind
+        self.threshold = CATEGORY_FUZZY_THRESHOLD if kind == "category" else BRAND_FUZZY_THRESHOLD
+        self.synonyms = CATEGORY_SYNONYMS if kind == "category" else {}
+        self.aliases = aliases if aliases is not None else canonical_aliases
+        self._index = {}
+        self._members = set()
+        for name in names:
+            self.resolve(name)
+
+    def _related(self, key: str, other: str) -> bool:
+        synonym = self.synonyms.get(key, key)
+        return synonym == self.synonyms.get(other, other) or _spelling_variants(synonym, other)
+
+    def _lookup(self, key: str) -> Optional[str]:
+        if key in self._index:
+            return self._index[key]
+        alias = self.aliases.get(self.kind, key)
+        # Aliases persisted before the word-for-word check may join different names; skip those
+        if alias is not None and self._related(key, canonical_key(alias)):
+            return self._index.get(canonical_key(alias), alias)
+        synonym = self.synonyms.get(key)
+        if synonym is not None and synonym in self._index:
+            return self._index[synonym]
+        # Only names new to this run pay for the fuzzy scan
+        matches = difflib.get_close_matches(synonym or key, list(self._index), n=3, cutoff=self.threshold)
+        return next((self._index[match] for match in matches if self._related(key, match)), None)
+
+    def resolve(self, name: str) -> str:
+        """Returns the canonical spelling of `name`, adding it to the list if it is new."""
+        name = name.strip()
+        key = canonical_key(name)
+        if not key:
+            return name
+        canonical = self._lookup(key)
+        if canonical is None:
+            canonical = name
+        elif canonical_key(canonical) != key:
+            # A merged variant; remember it so later runs skip the fuzzy scan
+            self.aliases.set(self.kind, key, canonical)
+        self._index[key] = canonical
+        self._index.setdefault(canonical_key(canonical), canonical)
+        if key in self.synonyms:
+            self._index.setdefault(self.synonyms[key], canonical)
+        if canonical not in self._members:
+            self._members.add(canonical)
+            self.append(canonical)
+        return canonical
+
+def _canonical_name(names, name: str) -> str:
+    if isinstance(names, CanonicalNames):
+        return names.resolve(name)
+    # Plain lists keep the original exact, case-insensitive match
+    existing = next((n for n in names if n.lower() == name.lower()), None)
+    if existing:
+        return existing
+    names.append(name)
+    return name
+
+def assign_brand_and_category(product, product_brand, product_category, categories, brands):
+    """
+    Assigns a brand and category to a product, reusing existing names.
+
+    With `CanonicalNames` lists, near-duplicate names are merged (see `CanonicalNames.resolve`);
+    plain lists only reuse exact case-insensitive matches.
+
+    Args:
+        product (dict): The product dictionary.
+        product_brand (str): The extracted brand name.
+        product_category (str): The extracted category name.
+        categories (list): The existing list of categories.
+        brands (list): The existing list of brands.
+
+    Returns:
+        dict: The product dictionary with 'productBrand' and 'productCategory' assigned.
+    """
+    # Update the product dictionary with the existing spelling of each name
+    product['productBrand'] = _canonical_name(brands, product_brand)
+    product['productCategory'] = _canonical_name(categories, product_category)
+
+    return product
+
+# Local rule-based brand/category classifier consulted before the LLM (LOCAL_CLASSIFIER=false disables it)
+LOCAL_CLASSIFIER = os.getenv("LOCAL_CLASSIFIER", "true").lower() in ("1", "true", "yes")
+# Classifications below this confidence go to the LLM
+LOCAL_CLASSIFIER_MIN_CONFIDENCE = float(os.getenv("LOCAL_CLASSIFIER_MIN_CONFIDENCE", "0.8"))
+# LLM extractions that must agree on a brand before it joins the dictionary
+LOCAL_CLASSIFIER_PROMOTE_AFTER = int(os.getenv("LOCAL_CLASSIFIER_PROMOTE_AFTER", "2"))
+
+# Well-known brands and the category most of their products belong to (brands that are also
+# common words, like Dove or Shark, are left for the LLM)
+SEED_BRANDS = {
+    "Apple": "Electronics", "Samsung": "Electronics", "Sony": "Electronics", "Logitech": "Electronics",
+    "Anker": "Electronics", "Bose": "Electronics", "JBL": "Electronics", "Lenovo": "Electronics",
+    "Dell": "Electronics", "HP": "Electronics", "Asus": "Electronics", "Acer": "Electronics",
+    "Canon": "Electronics", "Nikon": "Electronics", "GoPro": "Electronics", "Garmin": "Electronics",
+    "Fitbit": "Electronics", "Razer": "Electronics", "Corsair": "Electronics", "SanDisk": "Electronics",
+    "Nintendo": "Video Games", "PlayStation": "Video Games", "Xbox": "Video Games",
+    "Nespresso": "Home Appliances", "Keurig": "Home Appliances",
+    "KitchenAid": "Home Appliances", "Cuisinart": "Home Appliances", "Instant Pot": "Home Appliances",
+    "Dyson": "Home Appliances", "iRobot": "Home Appliances",
+    "Breville": "Home Appliances", "Vitamix": "Home Appliances", "Hamilton Beach": "Home Appliances",
+    "Nike": "Apparel", "Adidas": "Apparel", "Puma": "Apparel", "Under Armour": "Apparel",
+    "Levi's": "Apparel", "The North Face": "Apparel", "Patagonia": "Apparel",
+    "Uniqlo": "Apparel", "New Balance": "Footwear", "Skechers": "Footwear",
+    "Crocs": "Footwear", "Converse": "Footwear", "Vans": "Footwear",
+    "Casio": "Watches", "Seiko": "Watches", "Timex": "Watches", "Fossil": "Watches",
+    "Lego": "Toys", "Hasbro": "Toys", "Mattel": "Toys", "Barbie": "Toys", "Hot Wheels": "Toys",
+    "Olay": "Beauty", "L'Oreal": "Beauty", "Maybelline": "Beauty", "CeraVe": "Beauty",
+    "Neutrogena": "Beauty", "Gillette": "Personal Care", "Colgate": "Personal Care",
+    "Oral-B": "Personal Care", "Philips Sonicare": "Personal Care",
+    "Coleman": "Sports & Outdoors", "Yeti": "Sports & Outdoors", "Hydro Flask": "Sports & Outdoors",
+    "Wilson": "Sports & Outdoors", "Spalding": "Sports & Outdoors",
+    "HarperCollins": "Books", "Scholastic": "Books",
+    "Purina": "Pet Supplies", "Pedigree": "Pet Supplies", "KONG": "Pet Supplies",
+    "DeWalt": "Tools & Home Improvement", "Black+Decker": "Tools & Home Improvement",
+    "Makita": "Tools & Home Improvement", "Bosch": "Tools & Home Improvement",
+    "Pampers": "Baby", "Huggies": "Baby", "Graco": "Baby",
+}
+
+# Title keywords (single words or phrases) that decide the category on their own
+CATEGORY_KEYWORDS = {
+    "Electronics": (
+        "laptop", "notebook", "tablet", "smartphone", "phone case", "charger", "cable", "headphones",
+        "earbuds", "headset", "speaker", "monitor", "keyboard", "mouse", "webcam", "ssd", "hard drive",
+        "usb", "hdmi", "router", "camera", "smartwatch", "power bank", "tv", "television", "projector"
+    ),
+    "Video Games": ("video game", "controller", "console", "gaming"),
+    "Home Appliances": (
+        "blender", "air fryer", "coffee maker", "espresso", "toaster", "kettle", "microwave", "mixer",
+        "vacuum", "food processor", "pressure cooker", "humidifier", "dishwasher", "refrigerator"
+    ),
+    "Kitchen": ("cookware", "skillet", "frying pan", "knife set", "cutting board", "dinnerware", "mug"),
+    "Apparel": (
+        "shirt", "t-shirt", "hoodie", "jacket", "jeans", "pants", "shorts", "dress", "sweater",
+        "socks", "leggings", "coat", "sweatshirt"
+    ),
+    "Footwear": ("shoes", "sneakers", "boots", "sandals", "slippers", "running shoes"),
+    "Watches": ("watch",),
+    "Toys": ("toy", "puzzle", "doll", "action figure", "building set", "plush"),
+    "Books": ("book", "novel", "paperback", "hardcover", "cookbook", "biography"),
+    "Beauty": ("moisturizer", "serum", "mascara", "lipstick", "cleanser", "sunscreen", "shampoo", "conditioner"),
+    "Personal Care": ("toothbrush", "toothpaste", "razor", "deodorant"),
+    "Sports & Outdoors": ("tent", "sleeping bag", "yoga mat", "dumbbell", "bicycle", "water bottle", "cooler"),
+    "Pet Supplies": ("dog food", "cat food", "cat litter", "dog toy", "leash"),
+    "Tools & Home Improvement": ("drill", "screwdriver", "wrench", "tool set", "saw"),
+    "Baby": ("diapers", "stroller", "car seat", "baby wipes"),
+    "Groceries": ("coffee beans", "snack", "cereal", "tea", "protein powder"),
+}
+
+_TITLE_TOKEN = re.compile(r"[a-z0-9]+(?:['+&.-][a-z0-9]+)*")
+
+def _title_tokens(text: str):
+    return tuple(_TITLE_TOKEN.findall((text or "").lower()))
+
+class LocalBrandClassifier:
+    """
+    Classifies product titles from a brand dictionary and category keyword rules.
+
+    Brands are matched on the longest token prefix of the title (a brand found later in the
+    title scores lower); the category comes from the longest keyword in the title (on a tie, the
+    one agreeing with the brand's usual category) or, failing that, from the brand's usual
+    category. Brands the LLM keeps confirming are learned and persisted to
+    the SQLite file at `path`, so the dictionary grows with use.
+    """
+
+    # Confidence contributed by each kind of evidence; they add up to at most 1.0. A brand alone
+    # (with its usual category) stays below LOCAL_CLASSIFIER_MIN_CONFIDENCE: "Apple Cider
+    # Vinegar" must reach the LLM, so a category keyword is needed as well
+    PREFIX_BRAND_SCORE = 0.6
+    INNER_BRAND_SCORE = 0.35
+    KEYWORD_CATEGORY_SCORE = 0.4
+    BRAND_CATEGORY_SCORE = 0.15
+
+    def __init__(self, path: str, table: str = "local_brands", promote_after: int = LOCAL_CLASSIFIER_PROMOTE_AFTER):
+        self.path = path
+        self.table = table
+        self.promote_after = promote_after
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._db = SQLiteTable(
+            path, table, "key TEXT PRIMARY KEY, brand TEXT NOT NULL, categories TEXT NOT NULL, confirmations INTEGER NOT NULL"
+        )
+        self._brands = None
+        self._max_brand_tokens = 1
+        self._keywords = {}
+        for category, keywords in CATEGORY_KEYWORDS.items():
+            for keyword in keywords:
+                self._keywords[_title_tokens(keyword)] = category
+        self._max_keyword_tokens = max(len(tokens) for tokens in self._keywords)
+
+    def _load(self):
+        # brand tokens -> {'brand', 'categories': {category: count}, 'confirmations', 'seed'}
+        if self._brands is not None:
+            return self._brands
+        self._brands = {}
+        for brand, category in SEED_BRANDS.items():
+            self._add_brand(_title_tokens(brand), brand, {category: self.promote_after}, self.promote_after, seed=True)
+        # Learned brands are an optimization; the seed dictionary still works without them
+        for key, brand, categories, confirmations in self._db.fetch("SELECT key, brand, categories, confirmations FROM {table}") or []:
+            if tuple(key.split()) not in self._brands or not self._brands[tuple(key.split())]["seed"]:
+                self._add_brand(tuple(key.split()), brand, json.loads(categories), confirmations)
+        return self._brands
+
+    def _add_brand(self, tokens, brand, categories, confirmations, seed=False):
+        if not tokens:
+            return
+        self._brands[tokens] = {"brand": brand, "categories": dict(categories), "confirmations": confirmations, "seed": seed}
+        self._max_brand_tokens = max(self._max_brand_tokens, len(tokens))
+
+    def _known(self, entry) -> bool:
+        return entry["seed"] or entry["confirmations"] >= self.promote_after
+
+    def _match_brand(self, tokens):
+        brands = self._brands
+        for length in range(min(self._max_brand_tokens, len(tokens)), 0, -1):
+            entry = brands.get(tokens[:length])
+            if entry and self._known(entry):
+                return entry, self.PREFIX_BRAND_SCORE
+        for start in range(1, len(tokens)):
+            for length in range(min(self._max_brand_tokens, len(tokens) - start), 0, -1):
+                entry = brands.get(tokens[start:start + length])
+                if entry and self._known(entry):
+                    return entry, self.INNER_BRAND_SCORE
+        return None, 0.0
+
+    def _match_categories(self, tokens):
+        # Longest keyword wins so "running shoes" beats "shoes" and "phone case" beats "case";
+        # keywords tied on length all come back, in title order
+        best = []
+        best_length = 0
+        for start in range(len(tokens)):
+            for length in range(min(self._max_keyword_tokens, len(tokens) - start), 0, -1):
+                category = self._keywords.get(tokens[start:start + length])
+                if category is None:
+                    continue
+                if length > best_length:
+                    best, best_length = [], length
+                if length == best_length and category not in best:
+                    best.append(category)
+                break
+        return best
+
+    @staticmethod
+    def _usual_category(entry):
+        # The brand's category only counts when at least two thirds of its products share it
+        categories = entry["categories"]
+        if not categories:
+            return None
+        category, count = max(categories.items(), key=lambda item: item[1])
+        return category if count * 3 >= sum(categories.values()) * 2 else None
+
+    def classify(self, title: str):
+        """
+        Classifies a product title without calling the LLM.
+
+        Returns:
+            dict or None: {'productBrand', 'productCategory', 'confidence'}, or None when no brand
+            or no category could be found.
+        """
+        tokens = _title_tokens(title)
+        with self._lock:
+            self._load()
+            entry, brand_score = self._match_brand(tokens)
+            if entry is None:
+                self.misses += 1
+                return None
+            candidates = self._match_categories(tokens)
+            usual = self._usual_category(entry)
+            category_score = self.KEYWORD_CATEGORY_SCORE
+            if len(candidates) > 1 and usual in candidates:
+                # "Logitech ... Gaming Mouse": the keyword agreeing with the brand decides the tie
+                category = usual
+            elif candidates:
+                category = candidates[0]
+            else:
+                category = usual
+                category_score = self.BRAND_CATEGORY_SCORE
+            if category is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            confidence = round(min(1.0, brand_score + category_score), 2)
+            if len(candidates) > 1 and category != usual:
+                # Keywords pointing at different categories and nothing to break the tie: ask the LLM
+                confidence = min(confidence, round(LOCAL_CLASSIFIER_MIN_CONFIDENCE - 0.05, 2))
+            return {
+                'productBrand': entry["brand"],
+                'productCategory': category,
+                'confidence': confidence
+            }
+
+    def learn(self, title: str, brand: str, category: str) -> None:
+        """Records an LLM extraction; brands that appear in their own titles join the dictionary."""
+        brand_tokens = _title_tokens(brand)
+        title_tokens = _title_tokens(title)
+        if not brand_tokens or brand.strip().lower() == "unknown":
+            return
+        # Only brands spelled out in the title can be matched by the classifier later
+        if not any(title_tokens[start:start + len(brand_tokens)] == brand_tokens for start in range(len(title_tokens))):
+            return
+        with self._lock:
+            brands = self._load()
+            entry = brands.get(brand_tokens)
+            if entry is None:
+                self._add_brand(brand_tokens, brand.strip(), {}, 0)
+                entry = brands[brand_tokens]
+            if entry["seed"]:
+                return
+            entry["confirmations"] += 1
+            entry["categories"][category] = entry["categories"].get(category, 0) + 1
+            self._db.execute((
+                "INSERT OR REPLACE INTO {table} (key, brand, categories, confirmations) VALUES (?, ?, ?, ?)",
+                (" ".join(brand_tokens), entry["brand"], json.dumps(entry["categories"]), entry["confirmations"])
+            ))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            brands = self._load()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "known_brands": sum(1 for entry in brands.values() if self._known(entry))
+            }
+
+local_classifier = LocalBrandClassifier(EXTRACTION_CACHE_PATH)
+
+def classify_locally(product, categories, brands) -> bool:
+    """Assigns brand and category from `local_classifier` when it is confident enough; True if it did."""
+    if not LOCAL_CLASSIFIER:
+        return False
+    result = local_classifier.classify(product['productName'])
+    if result is None or result['confidence'] < LOCAL_CLASSIFIER_MIN_CONFIDENCE:
+        return False
+    assign_brand_and_category(product, result['productBrand'], result['productCategory'], categories, brands)
+    return True
+
+# Reuse the classification of a near-identical, already classified title (SIMILARITY_THRESHOLD=0 disables it)
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.7"))
+SIMILARITY_INDEX_MAX_ENTRIES = int(os.getenv("SIMILARITY_INDEX_MAX_ENTRIES", "50000"))
+
+class TitleSimilarityIndex:
+    """
+    MinHash/LSH index over the character trigrams of classified product titles.
+
+    Each title gets a MinHash signature of `bands * rows` values; titles sharing all values of
+    any band are candidates, so a lookup only compares against the few titles in its buckets.
+    A candidate matches when its estimated Jaccard similarity (the share of equal signature
+    values) reaches the threshold. Entries are persisted in SQLite at `path`.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, path: str, table: str = "title_signatures", bands: int = 16, rows: int = 4,
+                 max_entries: int = SIMILARITY_INDEX_MAX_ENTRIES):
+        self.path = path
+        self.table = table
+        self.bands = bands
+        self.rows = rows
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Fixed seed: signatures must be comparable across processes and runs
+        seeded = random.Random(0x5EED)
+        self._permutations = [
+            (seeded.randrange(1, self._PRIME), seeded.randrange(0, self._PRIME))
+            for _ in range(bands * rows)
+        ]
+        self._lock = threading.RLock()
+        self._db = SQLiteTable(path, table, "key TEXT PRIMARY KEY, signature BLOB NOT NULL, value TEXT NOT NULL, stored REAL NOT NULL")
+        self._entries = None
+        self._buckets = None
+        self._writes_since_eviction = 0
+        # A title is looked up before its batch and added after it; hash it once
+        self.signature = functools.lru_cache(maxsize=4096)(self._signature)
+
+    @staticmethod
+    def _shingles(title: str):
+        text = f" {normalize_product_title(title)} "
+        return {text[i:i + 3] for i in range(max(1, len(text) - 2))}
+
+    def _signature(self, title: str):
+        hashes = [zlib.crc32(shingle.encode()) for shingle in self._shingles(title)]
+        prime = self._PRIME
+        return tuple(min((a * h + b) % prime for h in hashes) for a, b in self._permutations)
+
+    def _band_keys(self, signature):
+        rows = self.rows
+        return [(band, signature[band * rows:(band + 1) * rows]) for band in range(self.bands)]
+
+    def _index(self, key, signature, value):
+        self._entries[key] = (signature, value)
+        for band_key in self._band_keys(signature):
+            self._buckets.setdefault(band_key, set()).add(key)
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        self._buckets = {}
+        rows = self._db.fetch("SELECT key, signature, value FROM {table} ORDER BY stored DESC LIMIT ?", (self.max_entries,))
+        for key, signature, value in rows or []:
+            signature = tuple(array.array('Q', signature))
+            if len(signature) == self.bands * self.rows:
+                self._index(key, signature, json.loads(value))
+
+    def lookup(self, title: str, threshold: float = SIMILARITY_THRESHOLD):
+        """
+        Returns the value stored for the most similar indexed title, or None if no indexed title
+        reaches `threshold`.
+        """
+        signature = self.signature(title)
+        with self._lock:
+            self._load()
+            candidates = set()
+            for band_key in self._band_keys(signature):
+                candidates.update(self._buckets.get(band_key, ()))
+            best, best_score = None, threshold
+            for key in candidates:
+                other, value = self._entries[key]
+                score = sum(1 for x, y in zip(signature, other) if x == y) / len(signature)
+                if score >= best_score:
+                    best, best_score = value, score
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return best
+
+    def add(self, title: str, value) -> None:
+        key = normalize_product_title(title)
+        signature = self.signature(title)
+        with self._lock:
+            self._load()
+            previous = self._entries.get(key)
+            if previous is not None:
+                for band_key in self._band_keys(previous[0]):
+                    self._buckets.get(band_key, set()).discard(key)
+            self._index(key, signature, value)
+            statements = [(
+                "INSERT OR REPLACE INTO {table} (key, signature, value, stored) VALUES (?, ?, ?, ?)",
+                (key, array.array('Q', signature).tobytes(), json.dumps(value), time.time())
+            )]
+            self._writes_since_eviction += 1
+            if self._writes_since_eviction >= PersistentLRUCache.EVICTION_INTERVAL:
+                self._writes_since_eviction = 0
+                statements.append((
+                    "DELETE FROM {table} WHERE key NOT IN (SELECT key FROM {table} ORDER BY stored DESC LIMIT ?)",
+                    (self.max_entries,)
+                ))
+            self._db.execute(*statements)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "entries": len(self._entries or ())
+            }
+
+similarity_index = TitleSimilarityIndex(EXTRACTION_CACHE_PATH)
+
+def classify_by_similarity(product, categories, brands) -> bool:
+    """Assigns the brand and category of the most similar classified title, if any; True if it did."""
+    if SIMILARITY_THRESHOLD <= 0:
+        return False
+    similar = similarity_index.lookup(product['productName'])
+    if similar is None:
+        return False
+    assign_brand_and_category(product, similar['productBrand'], similar['productCategory'], categories, brands)
+    return True
+
+def _classify_without_llm(product, categories, brands) -> bool:
+    return classify_locally(product, categories, brands) or classify_by_similarity(product, categories, brands)
+
+def extract_brand_and_category(product, categories, brands, budget: Optional[ReportBudget] = None):
     """
     Extracts the brand and assigns a category to a product using the LLM.
+
+    Previously extracted titles are served from `extraction_cache`, titles the local classifier
+    is confident about from `local_classifier` and near-duplicates of classified titles from
+    `similarity_index`, all without calling the LLM.
     
     Args:
         product (dict): The product dictionary.
         categories (list): The existing list of categories.
         brands (list): The existing list of brands.
+        budget (ReportBudget, optional): The time budget of the report being generated.
     
     Returns:
         dict: The product dictionary with 'productBrand' and 'productCategory' assigned.
     """
+    cache_key = normalize_product_title(product['productName'])
+    cached = extraction_cache.get(cache_key)
+    if cached:
+        return assign_brand_and_category(product, cached['productBrand'], cached['productCategory'], categories, brands)
+    if _classify_without_llm(product, categories, brands):
+        return product
+
     prompt = f"""
 You are a financial advisor analyzing a customer's shopping habits. Based on the product name and existing brands and categories, extract the brand and assign a category to the product.
 
@@ -134,14 +1831,15 @@ Ensure that the output JSON strictly adheres to the schema above. Do not include
 """
 
     try:
-        response = llm.invoke(prompt.strip())
+        response = invoke_with_retry("extraction", get_stage_llm("extraction"), prompt.strip(), budget)
         response_text = response.content.strip()
         
         # Attempt to parse the JSON output
         extracted = json.loads(response_text)
         
         # Validate the keys
-        if not all(k in extracted for k in ("productBrand", "productCategory")):
+        valid = all(k in extracted for k in ("productBrand", "productCategory"))
+        if not valid:
             #print(f"Invalid output format for '{product['productName']}': Missing 'productBrand' or 'productCategory'.")
             extracted['productBrand'] = "Unknown"
             extracted['productCategory'] = "Miscellaneous"
@@ -152,28 +1850,18 @@ Ensure that the output JSON strictly adheres to the schema above. Do not include
         
         if not isinstance(product_brand, str):
             product_brand = "Unknown"
+            valid = False
         if not isinstance(product_category, str):
             product_category = "Miscellaneous"
+            valid = False
         
-        # Check if the brand already exists (case-insensitive)
-        existing_brand = next((b for b in brands if b.lower() == product_brand.lower()), None)
-        if existing_brand:
-            product_brand = existing_brand
-        else:
-            brands.append(product_brand)
-        
-        # Check if the category already exists (case-insensitive)
-        existing_category = next((c for c in categories if c.lower() == product_category.lower()), None)
-        if existing_category:
-            product_category = existing_category
-        else:
-            categories.append(product_category)
-        
-        # Update the product dictionary
-        product['productBrand'] = product_brand
-        product['productCategory'] = product_category
-        
-        return product
+        # Only cache genuine extractions so failures get another chance next run
+        if valid:
+            extraction_cache.set(cache_key, {'productBrand': product_brand, 'productCategory': product_category})
+            local_classifier.learn(product['productName'], product_brand, product_category)
+            similarity_index.add(product['productName'], {'productBrand': product_brand, 'productCategory': product_category})
+
+        return assign_brand_and_category(product, product_brand, product_category, categories, brands)
     except json.JSONDecodeError as e:
         #print(f"JSON parsing error for '{product['productName']}': {e}")
         product['productBrand'] = "Unknown"
@@ -185,6 +1873,130 @@ Ensure that the output JSON strictly adheres to the schema above. Do not include
         product['productCategory'] = "Miscellaneous"
         return product
 
+def extract_brand_and_category_batch(product_names, categories, brands, budget: Optional[ReportBudget] = None):
+    """
+    Extracts brands and categories for several product names with a single LLM call.
+
+    Args:
+        product_names (list): Unique product names to classify.
+        categories (list): The existing list of categories.
+        brands (list): The existing list of brands.
+        budget (ReportBudget, optional): The time budget of the report being generated.
+
+    Returns:
+        dict or None: Normalized product name -> {'productBrand', 'productCategory'} for every
+        product the LLM returned (products missing from the response are absent from the dict),
+        or None when the call itself failed.
+    """
+    numbered_products = "\n".join(f"{idx}. {name}" for idx, name in enumerate(product_names, 1))
+    prompt = f"""
+You are a financial advisor analyzing a customer's shopping habits. Based on the product names and existing brands and categories, extract the brand and assign a category to every product listed below.
+
+Existing Brands: {brands if brands else "None"}
+Existing Categories: {categories if categories else "None"}
+
+Product Names:
+{numbered_products}
+
+Instructions:
+- Return exactly one entry per product, copying the product name verbatim into `productName`.
+- Identify the brand name from the product name.
+- Assign the product to one of the existing categories if applicable. If it doesn't fit any existing category, create a new appropriate category and assign it.
+- Output the result as a JSON object matching the `BrandCategoryExtractionBatch` schema.
+"""
+
+    try:
+        response = invoke_with_retry("extraction", get_stage_llm("extraction", BrandCategoryExtractionBatch), prompt.strip(), budget)
+    except Exception as e:
+        # print(f"An error occurred during batched brand and category extraction: {e}")
+        return None
+    if not response:
+        return None
+
+    extracted = {}
+    for item in response.products:
+        if item.productBrand.strip() and item.productCategory.strip():
+            extracted[normalize_product_title(item.productName)] = {
+                'productBrand': item.productBrand.strip(),
+                'productCategory': item.productCategory.strip()
+            }
+    return extracted
+
+def extract_brands_and_categories(products, categories, brands, batch_size: int = EXTRACTION_BATCH_SIZE, budget: Optional[ReportBudget] = None):
+    """
+    Assigns a brand and category to every product, classifying uncached titles in batches.
+
+    Cached titles, titles the local classifier is confident about and near-duplicates of
+    classified titles skip the LLM. Products the batched call does not return fall back to
+    `extract_brand_and_category`; when the batched call fails outright, its products are left
+    Unknown/Miscellaneous (and uncached) instead.
+
+    Args:
+        products (list): The product dictionaries.
+        categories (list): The existing list of categories.
+        brands (list): The existing list of brands.
+        batch_size (int): Products per LLM call; 0 or 1 extracts one product at a time.
+        budget (ReportBudget, optional): The time budget of the report being generated.
+
+    Returns:
+        list: The product dictionaries with 'productBrand' and 'productCategory' assigned.
+    """
+    if batch_size <= 1:
+        return [extract_brand_and_category(product, categories, brands, budget) for product in products]
+
+    # Serve cached titles first and collect the unique titles still to classify
+    pending = OrderedDict()
+    for product in products:
+        cache_key = normalize_product_title(product['productName'])
+        cached = extraction_cache.get(cache_key)
+        if cached:
+            assign_brand_and_category(product, cached['productBrand'], cached['productCategory'], categories, brands)
+        elif not _classify_without_llm(product, categories, brands):
+            pending.setdefault(cache_key, []).append(product)
+
+    pending_keys = list(pending)
+    position = 0
+    learned = False
+    while position < len(pending_keys):
+        chunk = []
+        while position < len(pending_keys) and len(chunk) < batch_size:
+            key = pending_keys[position]
+            position += 1
+            # Titles similar to ones an earlier batch classified no longer need the LLM
+            first, *others = pending[key]
+            if learned and classify_by_similarity(first, categories, brands):
+                for product in others:
+                    assign_brand_and_category(product, first['productBrand'], first['productCategory'], categories, brands)
+                continue
+            chunk.append(key)
+        if not chunk:
+            break
+        extracted = extract_brand_and_category_batch(
+            [pending[key][0]['productName'] for key in chunk], categories, brands, budget
+        )
+        if extracted is None:
+            # The call failed after its retries (rate limits, outage, spent budget); calling again
+            # per title would only add load. Left uncached, these titles are retried next run
+            for key in chunk:
+                for product in pending[key]:
+                    assign_brand_and_category(product, "Unknown", "Miscellaneous", categories, brands)
+            continue
+        for key in chunk:
+            result = extracted.get(key)
+            if result:
+                extraction_cache.set(key, result)
+                local_classifier.learn(pending[key][0]['productName'], result['productBrand'], result['productCategory'])
+                similarity_index.add(pending[key][0]['productName'], result)
+                for product in pending[key]:
+                    assign_brand_and_category(product, result['productBrand'], result['productCategory'], categories, brands)
+            else:
+                # Missing or invalid in the batched response; classify this title on its own
+                for product in pending[key]:
+                    extract_brand_and_category(product, categories, brands, budget)
+        learned = True
+
+    return products
+
 # Function to group products by category
 def prepare_category_prompt_data(products):
     from collections import defaultdict
@@ -201,47 +2013,311 @@ def prepare_brand_prompt_data(products):
         brand_products[product['productBrand']].append(product)
     return dict(brand_products)
 
-# Data computation functions (unchanged)
-def compute_total_spending_by_category(products):
+# Declarative description of the report graphs
+class GraphSpec(BaseModel):
+    graph_title: str = Field(..., description="Title of the graph")
+    x_variable: str = Field(..., description="Variable plotted on the x axis")
+    y_variable: str = Field(..., description="Variable plotted on the y axis")
+    group_by: Optional[str] = Field(None, description="Product field to group by; None keeps individual purchases")
+    metric: str = Field(..., description="'sum' of prices, 'count' of purchases, or 'values' (list of prices)")
+    data_key: Optional[str] = Field(None, description="If set, the dataset is wrapped as {data_key: data}")
+    explain: bool = Field(True, description="Whether the graph gets an LLM explanation")
+
+GRAPH_SPECS = [
+    # Graph 1: Total Spending by Product Category
+    GraphSpec(graph_title="Total Spending by Product Category", x_variable="Product Categories",
+              y_variable="Total Spending", group_by="productCategory", metric="sum"),
+    # Graph 2: Total Spending by Brand
+    GraphSpec(graph_title="Total Spending by Brand", x_variable="Product Brands",
+              y_variable="Total Spending", group_by="productBrand", metric="sum"),
+    # Graph 3: Spending Distribution Across E-commerce Sites
+    GraphSpec(graph_title="Spending Distribution Across E-commerce Sites", x_variable="E-commerce Sites",
+              y_variable="Total Spending", group_by="ecommerceSite", metric="sum"),
+    # Graph 4: Average Spending per Purchase
+    GraphSpec(graph_title="Average Spending per Purchase", x_variable="Individual Purchases",
+              y_variable="Purchase Amount", metric="values", data_key="purchase_prices"),
+    # Graph 5: Number of Purchases per Product Category
+    GraphSpec(graph_title="Number of Purchases per Product Category", x_variable="Product Categories",
+              y_variable="Number of Purchases", group_by="productCategory", metric="count"),
+]
+
+# Product histories at least this long are aggregated with numpy when it is installed
+VECTORIZED_AGGREGATION_THRESHOLD = int(os.getenv("VECTORIZED_AGGREGATION_THRESHOLD", "5000"))
+
+def _load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def _purchase_prices(product):
+    # Grouped products (see fetch_products) carry every purchase price in 'priceHistory'
+    history = product.get('priceHistory')
+    return history if history is not None else (product['productPrice'],)
+
+def _aggregate_python(products, specs):
     from collections import defaultdict
-    category_spending = defaultdict(float)
+    accumulators = []
+    updaters = []
+    for spec in specs:
+        if spec.metric == "values":
+            values = []
+            accumulators.append(values)
+            updaters.append(lambda product, prices, values=values: values.extend(prices))
+        elif spec.metric == "count":
+            counts = defaultdict(int)
+            accumulators.append(counts)
+            updaters.append(lambda product, prices, counts=counts, key=spec.group_by: counts.__setitem__(product[key], counts[product[key]] + len(prices)))
+        else:
+            totals = defaultdict(float)
+            accumulators.append(totals)
+            updaters.append(lambda product, prices, totals=totals, key=spec.group_by: totals.__setitem__(product[key], totals[product[key]] + sum(prices)))
+
+    # One scan of the products feeds every graph
     for product in products:
         if product['productPurchased']:
-            category_spending[product['productCategory']] += product['productPrice']
-    return dict(category_spending)
+            prices = _purchase_prices(product)
+            for update in updaters:
+                update(product, prices)
+
+    return [acc if isinstance(acc, list) else dict(acc) for acc in accumulators]
+
+def _aggregate_table(table, specs, np):
+    # Every purchase price with the row that owns it, in row order like the product scan
+    rows = np.frombuffer(table.price_rows, dtype=np.intc, count=len(table.price_rows))
+    order = np.argsort(rows, kind="stable")
+    rows = rows[order]
+    price_array = np.frombuffer(table.prices, dtype=np.float64, count=len(table.prices))[order]
+    purchased_rows = np.unique(rows)
+
+    results = []
+    for spec in specs:
+        if spec.metric == "values":
+            results.append(price_array.tolist())
+            continue
+        names = table.labels[spec.group_by].values
+        row_codes = np.frombuffer(table.codes[spec.group_by], dtype=np.intc, count=len(table))
+        codes = row_codes[rows]
+        assigned = codes >= 0
+        codes = codes[assigned]
+        # Labels in order of their first purchased row, as the product scan inserts them
+        seen_codes = row_codes[purchased_rows]
+        seen_codes = seen_codes[seen_codes >= 0]
+        unique_codes, first_rows = np.unique(seen_codes, return_index=True)
+        label_order = unique_codes[np.argsort(first_rows)].tolist()
+        if spec.metric == "count":
+            counts = np.bincount(codes, minlength=len(names))
+            results.append({names[code]: int(counts[code]) for code in label_order})
+        else:
+            totals = np.bincount(codes, weights=price_array[assigned], minlength=len(names))
+            results.append({names[code]: float(totals[code]) for code in label_order})
+    return results
 
-def compute_total_spending_by_brand(products):
-    from collections import defaultdict
-    brand_spending = defaultdict(float)
+def _aggregate_vectorized(products, specs, np):
+    group_fields = sorted({spec.group_by for spec in specs if spec.group_by})
+    prices = []
+    codes = {field: [] for field in group_fields}
+    labels = {field: {} for field in group_fields}
+
+    # One scan dictionary-encodes every group-by field; the group-bys themselves run in numpy
     for product in products:
         if product['productPurchased']:
-            brand_spending[product['productBrand']] += product['productPrice']
-    return dict(brand_spending)
+            product_prices = _purchase_prices(product)
+            prices.extend(product_prices)
+            for field in group_fields:
+                field_labels = labels[field]
+                code = field_labels.setdefault(product[field], len(field_labels))
+                codes[field].extend([code] * len(product_prices))
+
+    price_array = np.asarray(prices, dtype=np.float64)
+    results = []
+    for spec in specs:
+        if spec.metric == "values":
+            results.append(price_array.tolist())
+            continue
+        code_array = np.asarray(codes[spec.group_by], dtype=np.int64)
+        names = list(labels[spec.group_by])
+        if spec.metric == "count":
+            counts = np.bincount(code_array, minlength=len(names))
+            results.append({name: int(count) for name, count in zip(names, counts)})
+        else:
+            totals = np.bincount(code_array, weights=price_array, minlength=len(names))
+            results.append({name: float(total) for name, total in zip(names, totals)})
+    return results
+
+def aggregate_graph_datasets(products, specs: List[GraphSpec] = GRAPH_SPECS):
+    """
+    Computes the dataset of every graph spec in a single pass over the products.
+
+    A `ProductTable` with enough purchases is aggregated straight from its columns.
+
+    Args:
+        products (list): The product dictionaries, or a ProductTable.
+        specs (list): The GraphSpec entries to compute.
+
+    Returns:
+        list: One dataset per spec, in the same order.
+    """
+    if isinstance(products, ProductTable):
+        if len(products.prices) >= VECTORIZED_AGGREGATION_THRESHOLD:
+            np = _load_numpy()
+            if np is not None:
+                return _aggregate_table(products, specs, np)
+        return _aggregate_python(products, specs)
+    if len(products) >= VECTORIZED_AGGREGATION_THRESHOLD:
+        np = _load_numpy()
+        if np is not None:
+            return _aggregate_vectorized(products, specs, np)
+    return _aggregate_python(products, specs)
+
+def _single_spec(group_by, metric):
+    return GraphSpec(graph_title="", x_variable="", y_variable="", group_by=group_by, metric=metric)
+
+# Data computation functions (kept for callers that need a single dataset)
+def compute_total_spending_by_category(products):
+    return aggregate_graph_datasets(products, [_single_spec("productCategory", "sum")])[0]
+
+def compute_total_spending_by_brand(products):
+    return aggregate_graph_datasets(products, [_single_spec("productBrand", "sum")])[0]
 
 def compute_spending_by_ecommerce_site(products):
-    from collections import defaultdict
-    site_spending = defaultdict(float)
-    for product in products:
-        if product['productPurchased']:
-            site_spending[product['ecommerceSite']] += product['productPrice']
-    return dict(site_spending)
+    return aggregate_graph_datasets(products, [_single_spec("ecommerceSite", "sum")])[0]
 
 def compute_average_spending_per_purchase(products):
-    purchased_products = [p for p in products if p['productPurchased']]
-    purchase_prices = [p['productPrice'] for p in purchased_products]
-    return purchase_prices  # List of individual purchase amounts
+    return aggregate_graph_datasets(products, [_single_spec(None, "values")])[0]  # List of individual purchase amounts
 
 def compute_number_of_purchases_by_category(products):
-    from collections import defaultdict
-    category_counts = defaultdict(int)
-    for product in products:
+    return aggregate_graph_datasets(products, [_single_spec("productCategory", "count")])[0]
+
+# Prompt compaction: the category and brand prompts must fit the model's context window
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+
+def estimate_tokens(text: str) -> int:
+    # Rough estimate for Llama-style tokenizers (about 4 characters per token)
+    return (len(text) + 3) // 4
+
+def _compact_json(data) -> str:
+    return json.dumps(data, separators=(",", ":"))
+
+def _last_seen_seconds(product) -> float:
+    # 'lastSeen' is a datetime from MongoDB or an ISO string from the stage cache
+    last_seen = product.get('lastSeen')
+    if isinstance(last_seen, str):
+        try:
+            last_seen = datetime.datetime.fromisoformat(last_seen)
+        except ValueError:
+            return float("-inf")
+    if isinstance(last_seen, datetime.datetime):
+        return last_seen.timestamp()
+    if isinstance(last_seen, (int, float)):
+        return float(last_seen)
+    return float("-inf")
+
+def _collapse_products(products, detail_field: Optional[str]):
+    # One entry per distinct product name with purchase count and price statistics. Recency is
+    # (latest 'lastSeen', position): products without timestamps fall back to list order.
+    collapsed = OrderedDict()
+    for position, product in enumerate(products):
+        key = normalize_product_title(product['productName'])
+        entry = collapsed.get(key)
+        if entry is None:
+            entry = collapsed[key] = {"product": product, "prices": [], "sites": [], "recency": (float("-inf"), position)}
         if product['productPurchased']:
-            category_counts[product['productCategory']] += 1
-    return dict(category_counts)
+            entry["prices"].extend(_purchase_prices(product))
+        if product['ecommerceSite'] not in entry["sites"]:
+            entry["sites"].append(product['ecommerceSite'])
+        entry["recency"] = (max(entry["recency"][0], _last_seen_seconds(product)), position)
+
+    items = []
+    for entry in collapsed.values():
+        prices = entry["prices"]
+        item = {"name": entry["product"]['productName']}
+        if detail_field:
+            item[detail_field.replace("product", "").lower()] = entry["product"].get(detail_field)
+        item["sites"] = entry["sites"]
+        item["purchases"] = len(prices)
+        if len(prices) == 1:
+            item["price"] = round(prices[0], 2)
+        elif prices:
+            item["total"] = round(sum(prices), 2)
+            item["avg"] = round(sum(prices) / len(prices), 2)
+            item["min"] = round(min(prices), 2)
+            item["max"] = round(max(prices), 2)
+        items.append((sum(prices), entry["recency"], item))
+    return items
+
+def compact_product_groups(groups: Dict[str, List[Dict[str, Any]]], token_budget: int = PROMPT_TOKEN_BUDGET, detail_field: Optional[str] = None):
+    """
+    Serializes grouped products compactly and trims them to a token budget.
 
-# Function to generate the product category descriptions
-def generate_product_category_descriptions(products, user_info):
+    Duplicate products within a group are collapsed into one entry with a purchase count and
+    price statistics. If the result exceeds `token_budget` estimated tokens, products are kept
+    by priority (highest total spend, then most recently seen, then name) until the budget is spent.
+
+    Args:
+        groups (dict): Group name -> list of product dictionaries.
+        token_budget (int): Maximum estimated tokens for the serialized data.
+        detail_field (str, optional): Extra product field to include, e.g. 'productBrand'.
+
+    Returns:
+        tuple: (serialized data, stats) where stats reports the products kept and dropped,
+        the spend that was dropped and the estimated token count.
+    """
+    candidates = []
+    for group_order, (group_name, products) in enumerate(groups.items()):
+        for spend, recency, item in _collapse_products(products, detail_field):
+            candidates.append((spend, recency, group_order, group_name, item))
+    candidates.sort(key=lambda candidate: (-candidate[0], -candidate[1][0], -candidate[1][1], candidate[4]["name"]))
+
+    kept = {}
+    used_tokens = 2
+    dropped = 0
+    dropped_spend = 0.0
+    for spend, recency, group_order, group_name, item in candidates:
+        cost = estimate_tokens(_compact_json(item)) + 1
+        if group_name not in kept:
+            cost += estimate_tokens(_compact_json(group_name)) + 3
+        if used_tokens + cost > token_budget:
+            dropped += 1
+            dropped_spend += spend
+            continue
+        used_tokens += cost
+        kept.setdefault(group_name, (group_order, []))[1].append(item)
+
+    data = {
+        group_name: items
+        for group_name, (group_order, items) in sorted(kept.items(), key=lambda entry: entry[1][0])
+    }
+    serialized = _compact_json(data)
+    stats = {
+        "products": len(candidates),
+        "products_kept": len(candidates) - dropped,
+        "products_dropped": dropped,
+        "spend_dropped": round(dropped_spend, 2),
+        "estimated_tokens": estimate_tokens(serialized),
+        "token_budget": token_budget
+    }
+    return serialized, stats
+
+def _record_compaction(stats) -> None:
+    span = _current_span.get()
+    if span is not None:
+        span.add(products_dropped_from_prompts=stats["products_dropped"])
+
+def _omission_note(stats) -> str:
+    if not stats["products_dropped"]:
+        return ""
+    return (
+        f"\nNote: {stats['products_dropped']} lower-spend products (total spend {stats['spend_dropped']}) "
+        "were omitted to fit the prompt; base your analysis on the products listed.\n"
+    )
+
+# Prompt builders shared by the synchronous and asynchronous stage functions
+def build_category_prompt(products, user_info, token_budget: int = PROMPT_TOKEN_BUDGET) -> str:
     category_products = prepare_category_prompt_data(products)
+    category_data, compaction = compact_product_groups(category_products, token_budget, detail_field="productBrand")
+    _record_compaction(compaction)
 
     # Prepare the prompt
     prompt = f"""
@@ -250,10 +2326,10 @@ You are a financial advisor analyzing a customer's shopping habits. Based on the
 User Financial Goals: {json.dumps(user_info['goals'])}
 User Monthly Budget: {user_info['budget']}
 
-Data:
-
-{json.dumps(category_products, indent=2)}
+Data (per product: purchase count and price statistics):
 
+{category_data}
+{_omission_note(compaction)}
 Instructions:
 
 - For each product category, create an object with the category name and a list of products.
@@ -262,17 +2338,12 @@ Instructions:
 
 Remember to strictly adhere to the JSON structure specified in the schema.
 """
+    return prompt.strip()
 
-    # Call the LLM
-    try:
-        response = category_structured_llm.invoke(prompt.strip())
-        return response
-    except Exception as e:
-        #print(f"An error occurred in category analysis: {e}")
-        return None
-
-def generate_brand_descriptions(products, user_info):
+def build_brand_prompt(products, user_info, token_budget: int = PROMPT_TOKEN_BUDGET) -> str:
     brand_products = prepare_brand_prompt_data(products)
+    brand_data, compaction = compact_product_groups(brand_products, token_budget, detail_field="productCategory")
+    _record_compaction(compaction)
     
     prompt = f"""
     You are a financial advisor analyzing a customer's shopping habits. Based on the following products grouped by brand, along with the customer's financial goals and budget, generate a structured output.
@@ -280,10 +2351,10 @@ def generate_brand_descriptions(products, user_info):
     User Financial Goals: {json.dumps(user_info['goals'])}
     User Monthly Budget: {user_info['budget']}
 
-    Data:
+    Data (per product: purchase count and price statistics):
     
-    {json.dumps(brand_products, indent=2)}
-
+    {brand_data}
+    {_omission_note(compaction)}
     Instructions:
     - For each brand, create an object with the brand name and a list of products.
     - For each product, include the product name and a brief description (1-2 sentences) about the customer's habits related to that product.
@@ -291,15 +2362,9 @@ def generate_brand_descriptions(products, user_info):
 
     Ensure the output is a valid JSON object conforming to the `BrandDescriptions` schema.
     """
-    
-    try:
-        response = brand_structured_llm.invoke(prompt.strip())
-        return response  # Structured output handled by with_structured_output
-    except Exception as e:
-        # print(f"An error occurred in brand analysis: {e}")
-        return None
+    return prompt.strip()
 
-def generate_graph_explanation(graph_title: str, x_variable: str, y_variable: str, data: Dict[Any, Any], user_info) -> GraphExplanation:
+def build_graph_explanation_prompt(graph_title: str, x_variable: str, y_variable: str, data: Dict[Any, Any], user_info) -> str:
     prompt = f"""
     You are a financial advisor analyzing a customer's spending habits. Consider the customer's financial goals and budget while analyzing the data.
 
@@ -321,20 +2386,68 @@ def generate_graph_explanation(graph_title: str, x_variable: str, y_variable: st
 
     Ensure the output is a valid JSON object conforming to the `GraphExplanation` schema.
     """
-    
-    try:
-        response = llm.with_structured_output(GraphExplanation).invoke(prompt.strip())
-        return response  # Structured output handled by with_structured_output
-    except Exception as e:
-        # print(f"An error occurred while generating the explanation for '{graph_title}': {e}")
-        return None
+    return prompt.strip()
+
+def _summarize_values(values) -> Dict[str, Any]:
+    # A 'values' dataset lists every purchase amount and grows with the user's history; its
+    # distribution is what the explanation needs
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0}
+
+    def quantile(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2)
+
+    return {
+        "count": len(ordered),
+        "min": round(ordered[0], 2),
+        "max": round(ordered[-1], 2),
+        "mean": round(sum(ordered) / len(ordered), 2),
+        "p25": quantile(0.25),
+        "median": quantile(0.5),
+        "p75": quantile(0.75),
+        "p90": quantile(0.9)
+    }
 
-def generate_final_financial_advice(
+def _summarize_lists(data):
+    # 'values' datasets are a list, or a dict holding one under the spec's `data_key`
+    if isinstance(data, list):
+        return _summarize_values(data)
+    if isinstance(data, dict):
+        return {key: _summarize_values(value) if isinstance(value, list) else value for key, value in data.items()}
+    return data
+
+def build_graph_explanations_prompt(graphs: List[Dict[str, Any]], user_info) -> str:
+    graph_sections = "\n\n".join(
+        f"""Graph {index}
+Graph Title: {graph['graph_title']}
+Relationship: {graph['x_variable']} vs. {graph['y_variable']}
+Data: {_compact_json(_summarize_lists(graph['data']))}"""
+        for index, graph in enumerate(graphs, 1)
+    )
+    prompt = f"""
+You are a financial advisor analyzing a customer's spending habits. Consider the customer's financial goals and budget while analyzing the data.
+
+User Financial Goals: {json.dumps(user_info['goals'])}
+User Monthly Budget: {json.dumps(user_info['budget'])}
+
+{graph_sections}
+
+Instructions:
+- Write one explanation for every graph above, copying its Graph Title verbatim into `graph_title`.
+- For each graph, explain the relationship between its two variables and what it says about the customer's spending habits, considering their financial goals and budget.
+- Offer suggestions for financial planning if applicable.
+- Keep each explanation concise and informative.
+- Output the result as a JSON object matching the `GraphExplanationBatch` schema.
+"""
+    return prompt.strip()
+
+def build_final_advice_prompt(
     category_result: ProductCategoryDescriptions,
     brand_result: BrandDescriptions,
     graph_explanations: List[GraphExplanation],
     user_info
-) -> FinalFinancialAdvice:
+) -> str:
     # Convert all inputs to JSON
     category_json = category_result.dict() if category_result else {}
     brand_json = brand_result.dict() if brand_result else {}
@@ -377,164 +2490,1010 @@ Instructions:
 
 **Ensure that the output JSON strictly adheres to the schema above. Do not include any additional text or explanations.**
 """
+    return prompt.strip()
+
+# Map-reduce analysis: histories too large for one prompt are split into shards analyzed in parallel
+ANALYSIS_MAP_REDUCE = os.getenv("ANALYSIS_MAP_REDUCE", "true").lower() in ("1", "true", "yes")
+ANALYSIS_MAX_SHARDS = int(os.getenv("ANALYSIS_MAX_SHARDS", "8"))
+
+def shard_product_groups(
+    groups: Dict[str, List[Dict[str, Any]]],
+    token_budget: int = PROMPT_TOKEN_BUDGET,
+    detail_field: Optional[str] = None,
+    max_shards: int = ANALYSIS_MAX_SHARDS
+):
+    """
+    Splits grouped products into shards whose compact prompt data fits `token_budget`.
+
+    Groups are kept whole when they fit; larger groups are split by product (all entries
+    of one product stay together). At most `max_shards` shards are produced: pieces are
+    spread over them largest first, and each shard's prompt still trims by priority if
+    it ends up over budget.
+
+    Returns:
+        list: One list of product dictionaries per shard.
+    """
+    pieces = []
+    for group_name, products in groups.items():
+        same_product = OrderedDict()
+        for product in products:
+            same_product.setdefault(normalize_product_title(product['productName']), []).append(product)
+
+        header_cost = estimate_tokens(_compact_json(group_name)) + 3
+        piece, piece_cost = [], header_cost
+        for bucket in same_product.values():
+            cost = estimate_tokens(_compact_json(_collapse_products(bucket, detail_field)[0][2])) + 1
+            if piece and piece_cost + cost > token_budget:
+                pieces.append((piece_cost, piece))
+                piece, piece_cost = [], header_cost
+            piece.extend(bucket)
+            piece_cost += cost
+        if piece:
+            pieces.append((piece_cost, piece))
+
+    total_cost = sum(cost for cost, piece in pieces)
+    shard_count = max(1, min(max_shards, -(-total_cost // max(1, token_budget))))
+    if shard_count == 1:
+        return [[product for cost, piece in pieces for product in piece]]
+
+    # Largest pieces first, each onto the least loaded shard
+    shards = [[0, []] for _ in range(shard_count)]
+    for cost, piece in sorted(pieces, key=lambda entry: -entry[0]):
+        shard = min(shards, key=lambda entry: entry[0])
+        shard[0] += cost
+        shard[1].extend(piece)
+    return [products for cost, products in shards if products]
+
+def merge_category_descriptions(results: List[ProductCategoryDescriptions]) -> ProductCategoryDescriptions:
+    # A category split across shards becomes one entry again
+    merged = OrderedDict()
+    for result in results:
+        for category in result.categories:
+            key = category.category_name.strip().lower()
+            if key not in merged:
+                merged[key] = ProductCategory(category_name=category.category_name, products=[])
+            merged[key].products.extend(category.products)
+    return ProductCategoryDescriptions(categories=list(merged.values()))
+
+def merge_brand_descriptions(results: List[BrandDescriptions]) -> BrandDescriptions:
+    # A brand split across shards becomes one entry again
+    merged = OrderedDict()
+    for result in results:
+        for brand in result.brands:
+            key = brand.brand_name.strip().lower()
+            if key not in merged:
+                merged[key] = BrandAnalysis(brand_name=brand.brand_name, products=[])
+            merged[key].products.extend(brand.products)
+    return BrandDescriptions(brands=list(merged.values()))
+
+def _analysis_shards(groups, products, detail_field):
+    if not ANALYSIS_MAP_REDUCE:
+        return [products]
+    return shard_product_groups(groups, PROMPT_TOKEN_BUDGET, detail_field)
+
+def build_category_prompts(products, user_info) -> List[str]:
+    shards = _analysis_shards(prepare_category_prompt_data(products), products, "productBrand")
+    return [build_category_prompt(shard, user_info) for shard in shards]
+
+def build_brand_prompts(products, user_info) -> List[str]:
+    shards = _analysis_shards(prepare_brand_prompt_data(products), products, "productCategory")
+    return [build_brand_prompt(shard, user_info) for shard in shards]
+
+def _map_reduce_invoke(stage: str, runnable, prompts: List[str], merge, budget: Optional[ReportBudget] = None):
+    if len(prompts) == 1:
+        return invoke_with_retry(stage, runnable, prompts[0], budget)
+    with ThreadPoolExecutor(max_workers=len(prompts)) as pool:
+        # Each shard runs in a copy of the caller's context so its calls count towards the current span
+        futures = [
+            pool.submit(contextvars.copy_context().run, invoke_with_retry, stage, runnable, prompt, budget)
+            for prompt in prompts
+        ]
+        results = [future.result() for future in futures]
+    return merge(results)
+
+async def _amap_reduce_invoke(stage: str, runnable, prompts: List[str], merge, budget: Optional[ReportBudget] = None):
+    if len(prompts) == 1:
+        return await ainvoke_with_retry(stage, runnable, prompts[0], budget)
+    tasks = [asyncio.ensure_future(ainvoke_with_retry(stage, runnable, prompt, budget)) for prompt in prompts]
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        # One failed shard fails the stage; the others must not keep retrying and taking rate
+        # limit capacity for a report that has already been answered
+        for task in tasks:
+            task.cancel()
+    return merge(results)
+
+# Function to generate the product category descriptions
+def generate_product_category_descriptions(products, user_info, budget: Optional[ReportBudget] = None):
+    prompts = build_category_prompts(products, user_info)
+
+    # Call the LLM (one call per shard for very large histories)
+    try:
+        response = _map_reduce_invoke(
+            "category", get_stage_llm("category", ProductCategoryDescriptions), prompts, merge_category_descriptions, budget
+        )
+        return response
+    except LLMStageError as e:
+        #print(f"An error occurred in category analysis: {e}")
+        if budget is not None:
+            budget.record_failure(e)
+        return None
+
+def generate_brand_descriptions(products, user_info, budget: Optional[ReportBudget] = None):
+    prompts = build_brand_prompts(products, user_info)
+    
+    try:
+        response = _map_reduce_invoke("brand", get_stage_llm("brand", BrandDescriptions), prompts, merge_brand_descriptions, budget)
+        return response  # Structured output handled by with_structured_output
+    except LLMStageError as e:
+        # print(f"An error occurred in brand analysis: {e}")
+        if budget is not None:
+            budget.record_failure(e)
+        return None
+
+def generate_graph_explanation(graph_title: str, x_variable: str, y_variable: str, data: Dict[Any, Any], user_info, budget: Optional[ReportBudget] = None) -> GraphExplanation:
+    prompt = build_graph_explanation_prompt(graph_title, x_variable, y_variable, data, user_info)
+    
+    try:
+        response = invoke_with_retry("graph", get_stage_llm("graph", GraphExplanation), prompt, budget)
+        return response  # Structured output handled by with_structured_output
+    except LLMStageError as e:
+        # print(f"An error occurred while generating the explanation for '{graph_title}': {e}")
+        if budget is not None:
+            budget.record_failure(e)
+        return None
+
+# Explain every graph with one LLM call instead of one call per graph
+COMBINED_GRAPH_EXPLANATIONS = os.getenv("COMBINED_GRAPH_EXPLANATIONS", "false").lower() in ("1", "true", "yes")
+
+def _match_graph_explanations(graphs, response: Optional[GraphExplanationBatch]):
+    # Explanations are matched to graphs by title; missing or empty ones stay None
+    by_title = {}
+    for explanation in (response.explanations if response else []):
+        if explanation.explanation.strip():
+            by_title.setdefault(normalize_product_title(explanation.graph_title), explanation)
+    results = []
+    for graph in graphs:
+        explanation = by_title.get(normalize_product_title(graph["graph_title"]))
+        results.append(GraphExplanation(graph_title=graph["graph_title"], explanation=explanation.explanation) if explanation else None)
+    return results
+
+def generate_graph_explanations(graphs: List[Dict[str, Any]], user_info, budget: Optional[ReportBudget] = None) -> List[Optional[GraphExplanation]]:
+    """
+    Explains several graphs with a single LLM call ('values' datasets are summarized).
+
+    Graphs the combined response leaves out (or the whole batch, if that call fails or its
+    prompt exceeds PROMPT_TOKEN_BUDGET) are explained one at a time with `generate_graph_explanation`.
+
+    Returns:
+        list: One GraphExplanation per graph, in order (None where even the fallback failed).
+    """
+    prompt = build_graph_explanations_prompt(graphs, user_info)
+    response = None
+    # Past the budget (many brands or categories), the graphs are explained one at a time
+    if estimate_tokens(prompt) <= PROMPT_TOKEN_BUDGET:
+        try:
+            response = invoke_with_retry("graph", get_stage_llm("graph_batch", GraphExplanationBatch), prompt, budget)
+        except LLMStageError as e:
+            # print(f"An error occurred during the combined graph explanation: {e}")
+            pass
+
+    results = _match_graph_explanations(graphs, response)
+    for index, graph in enumerate(graphs):
+        if results[index] is None:
+            results[index] = generate_graph_explanation(
+                graph["graph_title"], graph["x_variable"], graph["y_variable"], graph["data"], user_info, budget
+            )
+    return results
+
+def generate_final_financial_advice(
+    category_result: ProductCategoryDescriptions,
+    brand_result: BrandDescriptions,
+    graph_explanations: List[GraphExplanation],
+    user_info,
+    budget: Optional[ReportBudget] = None
+) -> FinalFinancialAdvice:
+    prompt = build_final_advice_prompt(category_result, brand_result, graph_explanations, user_info)
 
     # Use structured output
-    final_financial_llm = llm.with_structured_output(FinalFinancialAdvice)
+    final_financial_llm = get_stage_llm("final", FinalFinancialAdvice)
     
     try:
-        response = final_financial_llm.invoke(prompt.strip())
+        response = invoke_with_retry("final", final_financial_llm, prompt, budget)
         return response  # Structured output handled by with_structured_output
-    except Exception as e:
+    except LLMStageError as e:
         # print(f"An error occurred while generating the final financial advice: {e}")
+        if budget is not None:
+            budget.record_failure(e)
         return None
 
+# Async variants of the stage functions (LangChain `ainvoke` path)
+async def agenerate_product_category_descriptions(products, user_info, budget: Optional[ReportBudget] = None):
+    # Sharding and compaction are CPU work; keep them off the event loop
+    prompts = await asyncio.to_thread(build_category_prompts, products, user_info)
+    try:
+        return await _amap_reduce_invoke(
+            "category", get_stage_llm("category", ProductCategoryDescriptions), prompts, merge_category_descriptions, budget
+        )
+    except LLMStageError as e:
+        # print(f"An error occurred in category analysis: {e}")
+        if budget is not None:
+            budget.record_failure(e)
+        return None
 
+async def agenerate_brand_descriptions(products, user_info, budget: Optional[ReportBudget] = None):
+    prompts = await asyncio.to_thread(build_brand_prompts, products, user_info)
+    try:
+        return await _amap_reduce_invoke("brand", get_stage_llm("brand", BrandDescriptions), prompts, merge_brand_descriptions, budget)
+    except LLMStageError as e:
+        # print(f"An error occurred in brand analysis: {e}")
+        if budget is not None:
+            budget.record_failure(e)
+        return None
 
-# Adjusted main function
-def generate_financial_advice(username: str):
+async def agenerate_graph_explanation(graph_title: str, x_variable: str, y_variable: str, data: Dict[Any, Any], user_info, budget: Optional[ReportBudget] = None) -> GraphExplanation:
+    prompt = build_graph_explanation_prompt(graph_title, x_variable, y_variable, data, user_info)
     try:
-        user_info, products = fetch_user_data(username)
-    except ValueError as ve:
-        # print(ve)
-        return
-    except Exception as e:
-        # print(f"An error occurred while fetching data for user '{username}': {e}")
+        return await ainvoke_with_retry("graph", get_stage_llm("graph", GraphExplanation), prompt, budget)
+    except LLMStageError as e:
+        # print(f"An error occurred while generating the explanation for '{graph_title}': {e}")
+        if budget is not None:
+            budget.record_failure(e)
+        return None
+
+async def agenerate_graph_explanations(graphs: List[Dict[str, Any]], user_info, budget: Optional[ReportBudget] = None) -> List[Optional[GraphExplanation]]:
+    prompt = build_graph_explanations_prompt(graphs, user_info)
+    response = None
+    if estimate_tokens(prompt) <= PROMPT_TOKEN_BUDGET:
+        try:
+            response = await ainvoke_with_retry("graph", get_stage_llm("graph_batch", GraphExplanationBatch), prompt, budget)
+        except LLMStageError as e:
+            # print(f"An error occurred during the combined graph explanation: {e}")
+            pass
+
+    results = _match_graph_explanations(graphs, response)
+    missing = [index for index, result in enumerate(results) if result is None]
+    fallbacks = await asyncio.gather(*(
+        agenerate_graph_explanation(
+            graphs[index]["graph_title"], graphs[index]["x_variable"], graphs[index]["y_variable"],
+            graphs[index]["data"], user_info, budget
+        )
+        for index in missing
+    ))
+    for index, result in zip(missing, fallbacks):
+        results[index] = result
+    return results
+
+async def agenerate_final_financial_advice(
+    category_result: ProductCategoryDescriptions,
+    brand_result: BrandDescriptions,
+    graph_explanations: List[GraphExplanation],
+    user_info,
+    budget: Optional[ReportBudget] = None
+) -> FinalFinancialAdvice:
+    prompt = build_final_advice_prompt(category_result, brand_result, graph_explanations, user_info)
+    try:
+        return await ainvoke_with_retry("final", get_stage_llm("final", FinalFinancialAdvice), prompt, budget)
+    except LLMStageError as e:
+        # print(f"An error occurred while generating the final financial advice: {e}")
+        if budget is not None:
+            budget.record_failure(e)
+        return None
+
+# Maximum number of analysis LLM calls in flight at once for a single report
+REPORT_MAX_CONCURRENCY = int(os.getenv("REPORT_MAX_CONCURRENCY", "7"))
+
+def build_graphs(datasets, specs: List[GraphSpec] = GRAPH_SPECS):
+    """
+    Pairs each spec with its dataset.
+
+    Returns:
+        list: One dict per graph with 'graph_title', 'x_variable', 'y_variable', 'data' and 'explain'.
+    """
+    graphs = []
+    for spec, data in zip(specs, datasets):
+        graphs.append({
+            "graph_title": spec.graph_title,
+            "x_variable": spec.x_variable,
+            "y_variable": spec.y_variable,
+            "data": {spec.data_key: data} if spec.data_key else data,
+            "explain": spec.explain
+        })
+    return graphs
+
+def compute_graph_datasets(products, specs: List[GraphSpec] = GRAPH_SPECS):
+    """Computes the data behind each report graph (see `build_graphs` for the shape)."""
+    return build_graphs(aggregate_graph_datasets(products, specs), specs)
+
+# Incremental reports: classify and aggregate only the events added since the last report
+INCREMENTAL_REPORTS = os.getenv("INCREMENTAL_REPORTS", "false").lower() in ("1", "true", "yes")
+
+def get_report_states_collection():
+    return get_database()['reportstates']
+
+def get_report_products_collection():
+    return get_database()['reportproducts']
+
+@_memoize
+def _ensure_report_products_index():
+    get_report_products_collection().create_index('userId')
+
+def _report_product_id(user_id, product):
+    return {'userId': user_id, 'listing': list(_product_key(product))}
+
+def load_report_products(user_id):
+    """The user's classified products stored by `update_report_state`, one document per listing."""
+    _ensure_report_products_index()
+    return list(get_report_products_collection().find({'userId': user_id}, {'_id': 0, 'userId': 0}).sort('firstSeen', 1))
+
+def save_report_products(user_id, products, replace: bool = False) -> None:
+    """
+    Upserts the given classified products, one document per listing; with `replace`, they
+    replace every product stored for the user.
+    """
+    _ensure_report_products_index()
+    collection = get_report_products_collection()
+    documents = [dict(product, _id=_report_product_id(user_id, product), userId=user_id) for product in products]
+    if replace:
+        collection.delete_many({'userId': user_id})
+        if documents:
+            collection.insert_many(documents, ordered=False)
         return
+    for document in documents:
+        collection.replace_one({'_id': document['_id']}, document, upsert=True)
 
-    categories = []
-    brands = []
+def merge_classified_products(previous_products, new_products):
+    """
+    Merges newly classified products into the stored ones, one entry per product
+    (see `dedupe_product_events`).
 
-    # Extract brands and categories for each product
-    updated_products = []
-    for product in products:
-        updated_product = extract_brand_and_category(product, categories, brands)
-        updated_products.append(updated_product)
-    products = updated_products
-    # print("1")
+    Every entry keeps all of its purchase prices in 'priceHistory' (see `_purchase_prices`).
+    """
+    return dedupe_product_events(list(previous_products) + list(new_products))
+
+def merge_graph_datasets(previous_datasets, new_datasets, specs: List[GraphSpec] = GRAPH_SPECS):
+    # Sums and counts add up per key; 'values' datasets are concatenated
+    merged = []
+    for spec, previous, new in zip(specs, previous_datasets, new_datasets):
+        if spec.metric == "values":
+            merged.append(list(previous) + list(new))
+            continue
+        combined = dict(previous)
+        for key, value in new.items():
+            combined[key] = combined.get(key, 0) + value
+        merged.append(combined)
+    return merged
+
+def _encode_datasets(datasets, specs):
+    # Stored as [key, value] pairs because brand names may contain '.' or start with '$'. 'values'
+    # datasets grow with every purchase, so they are rebuilt from the stored products instead.
+    return [
+        {"graph_title": spec.graph_title, "data": None if spec.metric == "values" else [[k, v] for k, v in data.items()]}
+        for spec, data in zip(specs, datasets)
+    ]
+
+def _decode_datasets(stored, specs, products):
+    # Returns None when the stored aggregates don't match the current graph specs
+    stored_by_title = {entry["graph_title"]: entry["data"] for entry in stored or []}
+    if any(spec.graph_title not in stored_by_title for spec in specs):
+        return None
+    return [
+        aggregate_graph_datasets(products, [spec])[0] if spec.metric == "values" else {k: v for k, v in stored_by_title[spec.graph_title]}
+        for spec in specs
+    ]
+
+def compute_incremental_fingerprint(user_id, user_info, state) -> str:
+    """Content hash of the user's goals/budget and the report state's checkpoint and event count."""
+    return _content_hash({
+        'user': str(user_id), 'info': user_info,
+        'checkpoint': state.get('checkpoint'), 'events': state.get('eventCount', 0)
+    })
+
+def fetch_incremental_fingerprint(user_id, user_info) -> Optional[str]:
+    """
+    Fingerprint of an up-to-date report state (see `compute_incremental_fingerprint`), or None
+    when there is no state or events newer than its checkpoint exist.
 
-    # Generate category-based descriptions
-    category_result = generate_product_category_descriptions(products, user_info)
-    while not category_result:
-        category_result = generate_product_category_descriptions(products, user_info)
-    # print("2")
-    # Generate brand-based descriptions
-    brand_result = generate_brand_descriptions(products, user_info)
-    while not brand_result:
-        brand_result = generate_brand_descriptions(products, user_info)
-    # print("3")
-    # Graph 1: Total Spending by Product Category
-    data1 = compute_total_spending_by_category(products)
-    explanation1 = generate_graph_explanation(
-        graph_title="Total Spending by Product Category",
-        x_variable="Product Categories",
-        y_variable="Total Spending",
-        data=data1,
-        user_info=user_info
-    )
+    Unlike `fetch_report_fingerprint` this reads no event, only counts the new ones (served by
+    the {userId, timestamp} index); events are assumed not to change once recorded.
+    """
+    state = get_report_states_collection().find_one({'_id': user_id}, {'checkpoint': 1, 'eventCount': 1})
+    if not state or not state.get('checkpoint'):
+        return None
+    if get_productevents_collection().count_documents(_new_events_query(user_id, state['checkpoint']), limit=1):
+        return None
+    return compute_incremental_fingerprint(user_id, user_info, state)
 
-    while not explanation1:
-        explanation1 = generate_graph_explanation(
-            graph_title="Total Spending by Product Category",
-            x_variable="Product Categories",
-            y_variable="Total Spending",
-            data=data1,
-            user_info=user_info
-        )
-    # print("4")
-    # Graph 2: Total Spending by Brand
-    data2 = compute_total_spending_by_brand(products)
-    explanation2 = generate_graph_explanation(
-        graph_title="Total Spending by Brand",
-        x_variable="Product Brands",
-        y_variable="Total Spending",
-        data=data2,
-        user_info=user_info
-    )
-    while not explanation2:
-        explanation2 = generate_graph_explanation(
-            graph_title="Total Spending by Brand",
-            x_variable="Product Brands",
-            y_variable="Total Spending",
-            data=data2,
-            user_info=user_info,
-        )
-    # print("5")
-    # Graph 3: Spending Distribution Across E-commerce Sites
-    data3 = compute_spending_by_ecommerce_site(products)
-    explanation3 = generate_graph_explanation(
-        graph_title="Spending Distribution Across E-commerce Sites",
-        x_variable="E-commerce Sites",
-        y_variable="Total Spending",
-        data=data3,
-        user_info=user_info
-    )
-    while not explanation3:
-        explanation3 = generate_graph_explanation(
-            graph_title="Spending Distribution Across E-commerce Sites",
-            x_variable="E-commerce Sites",
-            y_variable="Total Spending",
-            data=data3,
-            user_info=user_info
-        )
-    # print("6")
-    # Graph 4: Average Spending per Purchase
-    data4 = compute_average_spending_per_purchase(products)
-    explanation4 = generate_graph_explanation(
-        graph_title="Average Spending per Purchase",
-        x_variable="Individual Purchases",
-        y_variable="Purchase Amount",
-        data={"purchase_prices": data4},
-        user_info=user_info
-    )
-    while not explanation4:
-        explanation4 = generate_graph_explanation(
-            graph_title="Average Spending per Purchase",
-            x_variable="Individual Purchases",
-            y_variable="Purchase Amount",
-            data={"purchase_prices": data4},
-            user_info=user_info
-        )
-    # print("7")
-    # Graph 5: Number of Purchases per Product Category
-    data5 = compute_number_of_purchases_by_category(products)
-    explanation5 = generate_graph_explanation(
-        graph_title="Number of Purchases per Product Category",
-        x_variable="Product Categories",
-        y_variable="Number of Purchases",
-        data=data5,
-        user_info=user_info
+def update_report_state(user_id, budget: Optional[ReportBudget] = None, specs: List[GraphSpec] = GRAPH_SPECS):
+    """
+    Brings the user's stored report state up to date and returns it.
+
+    The state (collection 'reportstates') holds a checkpoint of the last processed event, the
+    number of events processed and the running sum/count graph aggregates; the classified
+    products are stored one document per listing (collection 'reportproducts', see
+    `save_report_products`), so no document grows with the user's history. Only events newer
+    than the checkpoint are fetched (served by the {userId, timestamp} index) and classified,
+    and only the listings they touch are written back.
+
+    Returns:
+        tuple: (products, datasets) covering the user's whole history.
+    """
+    states = get_report_states_collection()
+    state = states.find_one({'_id': user_id}) or {}
+    # States written before products had their own collection carry them inline
+    legacy_products = state.get('products')
+    previous_products = legacy_products if legacy_products is not None else load_report_products(user_id)
+    previous_datasets = _decode_datasets(state.get('aggregates'), specs, previous_products)
+
+    new_products, checkpoint = fetch_new_product_events(user_id, state.get('checkpoint'))
+    if not new_products and previous_datasets is not None and legacy_products is None:
+        return previous_products, previous_datasets
+    event_count = state.get('eventCount', 0) + len(new_products)
+
+    # Classify each new product once, however many times it was viewed
+    if DEDUPE_PRODUCT_EVENTS:
+        new_products = dedupe_product_events(new_products)
+
+    # Reuse the names already assigned so new products join the existing groups
+    categories = CanonicalNames("category", (p['productCategory'] for p in previous_products))
+    brands = CanonicalNames("brand", (p['productBrand'] for p in previous_products))
+    new_products = extract_brands_and_categories(new_products, categories, brands, EXTRACTION_BATCH_SIZE, budget)
+
+    products = merge_classified_products(previous_products, new_products)
+    if previous_datasets is None:
+        datasets = aggregate_graph_datasets(products, specs)
+    else:
+        datasets = merge_graph_datasets(previous_datasets, aggregate_graph_datasets(new_products, specs), specs)
+
+    if legacy_products is not None or not previous_products:
+        save_report_products(user_id, products, replace=True)
+    else:
+        touched = {_product_key(product) for product in new_products}
+        save_report_products(user_id, [product for product in products if _product_key(product) in touched])
+    states.replace_one(
+        {'_id': user_id},
+        {
+            '_id': user_id,
+            'checkpoint': checkpoint,
+            'eventCount': event_count,
+            'aggregates': _encode_datasets(datasets, specs),
+            'updatedAt': time.time()
+        },
+        upsert=True
     )
-    while not explanation5:
-        explanation5 = generate_graph_explanation(
-            graph_title="Number of Purchases per Product Category",
-            x_variable="Product Categories",
-            y_variable="Number of Purchases",
-            data=data5,
-            user_info=user_info
-        )
-    # print("8")
-    # Collect all graph explanations
-    graph_explanations = [explanation1, explanation2, explanation3, explanation4, explanation5]
-
-    # Generate final financial advice
-    final_advice = generate_final_financial_advice(category_result, brand_result, graph_explanations, user_info)
-    while not final_advice:
-        final_advice = generate_final_financial_advice(category_result, brand_result, graph_explanations, user_info)
-    # print("9")
-    result = {
+    return products, datasets
+
+def _graph_data_section(graph):
+    return {
+        "graph_title": graph["graph_title"],
+        "x_variable": graph["x_variable"],
+        "y_variable": graph["y_variable"],
+        "data": graph["data"]
+    }
+
+def _graph_explanation_section(explanation: GraphExplanation):
+    return {
+        "title": explanation.graph_title,
+        "explanation": explanation.explanation
+    }
+
+def build_report(category_result, brand_result, graph_explanations, final_advice, user_info, graphs=None):
+    return {
         "category_analysis": category_result.dict() if category_result else None,
         "brand_analysis": brand_result.dict() if brand_result else None,
         "graph_explanations": [
-            {
-                "title": explanation.graph_title,
-                "explanation": explanation.explanation
-            } for explanation in graph_explanations if explanation
+            _graph_explanation_section(explanation) for explanation in graph_explanations if explanation
         ],
+        "graph_data": [_graph_data_section(graph) for graph in graphs or []],
         "final_advice": final_advice.dict() if final_advice else None,
         "user_info": user_info
     }
 
-    return result
+def build_failure_report(failure: LLMStageError, user_info, graphs=None, category_result=None, brand_result=None,
+                         graph_explanations=(), final_advice=None):
+    # Same shape as build_report: sections that completed are kept, failed or skipped ones stay empty
+    report = build_report(category_result, brand_result, graph_explanations, final_advice, user_info, graphs)
+    report["error"] = failure.to_dict()
+    return report
+
+async def _alimited(semaphore, coroutine):
+    # Every LLM attempt `coroutine` makes, map-reduce shards and fallbacks included, takes its
+    # own slot of `semaphore` (see `ainvoke_with_retry`)
+    token = _llm_slots.set(semaphore)
+    try:
+        return await coroutine
+    finally:
+        _llm_slots.reset(token)
+
+# Process-wide metric totals exported in Prometheus text format (see METRICS_FILE)
+_metric_totals = OrderedDict()
+_metric_totals_lock = threading.Lock()
+
+def _prometheus_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def record_report_metrics(summary: Dict[str, Any], metrics_file: Optional[str] = None) -> None:
+    """Adds one report's metrics summary to the process totals and rewrites `metrics_file`."""
+    with _metric_totals_lock:
+        def add(metric, labels, amount):
+            key = (metric, labels)
+            _metric_totals[key] = _metric_totals.get(key, 0) + amount
+
+        add("ai_agents_reports_total", (), 1)
+        add("ai_agents_report_seconds_total", (), summary["total_seconds"])
+        for name, span in summary["spans"].items():
+            labels = (("span", name),)
+            add("ai_agents_span_runs_total", labels, 1)
+            add("ai_agents_span_seconds_total", labels, span["wall_seconds"])
+            add("ai_agents_llm_calls_total", labels, span["llm_calls"])
+            add("ai_agents_llm_retries_total", labels, span["retries"])
+            add("ai_agents_llm_prompt_tokens_total", labels, span["prompt_tokens"])
+            add("ai_agents_llm_completion_tokens_total", labels, span["completion_tokens"])
+            add("ai_agents_llm_rate_limit_wait_seconds_total", labels, span["rate_limit_wait_seconds"])
+        for name, cache in summary["caches"].items():
+            add("ai_agents_cache_hits_total", (("cache", name),), cache["hits"])
+            add("ai_agents_cache_misses_total", (("cache", name),), cache["misses"])
+
+        metrics_file = metrics_file if metrics_file is not None else METRICS_FILE
+        if not metrics_file:
+            return
+        # The text format wants every sample of a metric in one block under its TYPE line
+        samples = OrderedDict()
+        for (metric, labels), value in _metric_totals.items():
+            samples.setdefault(metric, []).append((labels, value))
+        lines = []
+        for metric, metric_samples in samples.items():
+            lines.append(f"# TYPE {metric} counter")
+            for labels, value in metric_samples:
+                label_text = ",".join(f'{name}="{_prometheus_label(label)}"' for name, label in labels)
+                lines.append(f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+
+        # Write then rename so scrapers never read a half-written file
+        temporary_path = f"{metrics_file}.tmp"
+        with open(temporary_path, "w") as metrics_output:
+            metrics_output.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, metrics_file)
+
+def _finish_report(report, metrics: ReportMetrics, include_metrics: bool):
+    summary = metrics.summary()
+    try:
+        record_report_metrics(summary)
+    except OSError:
+        # Metrics export must never fail a report
+        pass
+    if include_metrics and report is not None:
+        report = dict(report, metrics=summary)
+    return report
+
+async def _in_span(metrics: ReportMetrics, name: str, coroutine):
+    with metrics.span(name):
+        return await coroutine
+
+def _needs_classification(spec: GraphSpec) -> bool:
+    return spec.group_by in ("productCategory", "productBrand")
+
+def _report_sections(report):
+    # Replays a finished (cached) report as the sections a live run would have streamed
+    for graph in report.get("graph_data", []):
+        yield "graph_data", graph
+    yield "category_analysis", report["category_analysis"]
+    yield "brand_analysis", report["brand_analysis"]
+    for explanation in report["graph_explanations"]:
+        yield "graph_explanation", explanation
+    yield "final_advice", report["final_advice"]
+
+# Report DAG: every stage declares its inputs and is cached under a hash of them
+class PipelineStage:
+    """
+    One node of the report DAG.
+
+    `run(*values)` receives the outputs of `inputs` in order and returns the stage's output or an
+    awaitable of it. A None output means the stage failed; stages depending on it are skipped.
+    Cacheable stages are stored via `encode` (to a JSON-compatible value) and restored via
+    `decode`; `version` is part of the cache key, so changing it invalidates earlier results.
+    Every output is also hashed through `encode` for the cache keys of the stages after it, so a
+    stage that is not cached may encode just what identifies its output.
+    """
+
+    def __init__(self, name: str, inputs: List[str], run, cacheable: bool = False,
+                 encode=None, decode=None, version: str = ""):
+        self.name = name
+        self.inputs = inputs
+        self.run = run
+        self.cacheable = cacheable
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+        self.version = version
+
+def _json_default(value):
+    # Product tables and records hash like the product dictionaries they stand for
+    if isinstance(value, (ProductTable, ProductRecord)):
+        return value.to_json()
+    return str(value)
+
+def _content_hash(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=_json_default).encode()).hexdigest()
+
+async def run_stage_graph(stages: List[PipelineStage], sources: Dict[str, Any], cache: Optional[PersistentLRUCache] = None, refresh: bool = False):
+    """
+    Runs a DAG of stages, yielding (stage name, output, cached) as each stage finishes.
+
+    A stage starts as soon as all of its inputs (source values or other stages' outputs) are
+    available; stages that are ready together start in declaration order. Each cacheable
+    stage is looked up in `cache` under a hash of its name, version and the content hashes of
+    its inputs, so only stages whose inputs changed are recomputed. `refresh` skips the
+    lookups (results are still stored).
+
+    Raises:
+        ValueError: If a stage depends on an unknown input or the stages form a cycle.
+    """
+    known = set(sources) | {stage.name for stage in stages}
+    for stage in stages:
+        missing = [name for name in stage.inputs if name not in known]
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' depends on unknown input(s) {missing}")
+
+    outputs = dict(sources)
+    # Encoding, hashing and the cache's SQLite I/O scale with the inputs (every product of a
+    # user), so they run in worker threads rather than on the event loop
+    hashes = {name: await asyncio.to_thread(_content_hash, value) for name, value in sources.items()}
+    order = {stage.name: index for index, stage in enumerate(stages)}
+    waiting = list(stages)
+    running = {}
+
+    def store(stage, key, value, encoded):
+        encoded = stage.encode(value) if encoded is None else encoded
+        if key is not None:
+            cache.set(key, encoded)
+        return _content_hash(encoded)
+
+    async def finish(stage, key, value, encoded=None):
+        outputs[stage.name] = value
+        hashes[stage.name] = None if value is None else await asyncio.to_thread(store, stage, key, value, encoded)
+
+    try:
+        while waiting or running:
+            # Start (or finish inline) every stage whose inputs are ready; repeat until none is
+            started = True
+            while started:
+                started = False
+                for stage in list(waiting):
+                    if not all(name in outputs for name in stage.inputs):
+                        continue
+                    waiting.remove(stage)
+                    started = True
+                    values = [outputs[name] for name in stage.inputs]
+                    if any(value is None for value in values):
+                        await finish(stage, None, None)
+                        yield stage.name, None, False
+                        continue
+
+                    key = None
+                    if stage.cacheable and cache is not None:
+                        key = _content_hash([stage.name, stage.version, [hashes[name] for name in stage.inputs]])
+                        cached = None if refresh else await asyncio.to_thread(cache.get, key)
+                        if cached is not None:
+                            value = stage.decode(cached)
+                            await finish(stage, None, value, cached)
+                            yield stage.name, value, True
+                            continue
+
+                    result = stage.run(*values)
+                    if inspect.isawaitable(result):
+                        running[asyncio.ensure_future(result)] = (stage, key)
+                    else:
+                        await finish(stage, key, result)
+                        yield stage.name, result, False
+
+            if not running:
+                if waiting:
+                    raise ValueError(f"Stages {[stage.name for stage in waiting]} form a cycle")
+                break
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda done_task: order[running[done_task][0].name]):
+                stage, key = running.pop(task)
+                value = task.result()
+                await finish(stage, key, value)
+                yield stage.name, value, False
+    finally:
+        # The consumer may stop early; don't leave stages running
+        for task in running:
+            task.cancel()
+
+def _classifications(products):
+    # What extraction decided, per title: identifies the 'classified' output, since the products
+    # themselves are hashed as the 'products' source
+    return {product['productName']: [product.get('productBrand'), product.get('productCategory')] for product in products}
+
+def _classify_products(products, budget: Optional[ReportBudget] = None):
+    return extract_brands_and_categories(
+        products, CanonicalNames("category"), CanonicalNames("brand"), EXTRACTION_BATCH_SIZE, budget
+    )
+
+def _stage_version(stage: str) -> str:
+    route = LLM_ROUTES.get(stage, LLM_ROUTES["default"])
+    return f"{STAGE_CACHE_VERSION}:{route.model_dump_json()}"
+
+async def _complete_or_none(coroutine):
+    # A partial list of results must neither be cached nor feed the final advice
+    results = await coroutine
+    return None if any(result is None for result in results) else results
+
+def build_report_stages(user_info, budget: ReportBudget, metrics: ReportMetrics, semaphore,
+                        datasets=None, specs: List[GraphSpec] = GRAPH_SPECS,
+                        combined_graph_explanations: bool = COMBINED_GRAPH_EXPLANATIONS) -> List[PipelineStage]:
+    """
+    Declares the report DAG over the sources 'user_info' and 'products'.
+
+    Stages: 'classified' (brand/category extraction), 'graph_data:<title>' per graph,
+    'category', 'brand', 'graph:<title>' per explained graph (or a single 'graphs' stage with
+    `combined_graph_explanations`) and 'final'. LLM stages share `semaphore` and run in metrics
+    spans. With `datasets` (incremental reports), 'products' are already classified and the
+    graphs come from the stored aggregates.
+    """
+    def llm(span, coroutine):
+        return _alimited(semaphore, _in_span(metrics, span, coroutine))
+
+    stages = []
+    if datasets is None:
+        # Not cached: extraction_cache already skips the LLM for known titles, and storing every
+        # product per report would only duplicate the user's history in stage_cache
+        stages.append(PipelineStage(
+            "classified", ["products"],
+            lambda products: _in_span(metrics, "extraction", asyncio.to_thread(_classify_products, products, budget)),
+            encode=_classifications, version=_stage_version("extraction")
+        ))
+        for spec in specs:
+            # Graphs over raw event fields don't wait for extraction
+            source = "classified" if _needs_classification(spec) else "products"
+            stages.append(PipelineStage(
+                f"graph_data:{spec.graph_title}", [source],
+                lambda products, spec=spec: compute_graph_datasets(products, [spec])[0]
+            ))
+    else:
+        stages.append(PipelineStage("classified", ["products"], lambda products: products, encode=_classifications))
+        prebuilt = build_graphs(datasets, specs)
+        for spec, graph in zip(specs, prebuilt):
+            stages.append(PipelineStage(f"graph_data:{spec.graph_title}", ["classified"], lambda products, graph=graph: graph))
+
+    def analysis_stage(name, schema, generate):
+        # 'products' keys the cache on prices and counts too; 'classified' only hashes the labels
+        return PipelineStage(
+            name, ["classified", "user_info", "products"],
+            lambda products, info, _: llm(name, generate(products, info, budget)),
+            cacheable=True, encode=lambda result: result.dict(), decode=lambda data: schema(**data),
+            version=_stage_version(name)
+        )
+
+    stages.append(analysis_stage("category", ProductCategoryDescriptions, agenerate_product_category_descriptions))
+    stages.append(analysis_stage("brand", BrandDescriptions, agenerate_brand_descriptions))
+
+    explained = [spec for spec in specs if spec.explain]
+    if combined_graph_explanations and explained:
+        explanation_stages = ["graphs"]
+        stages.append(PipelineStage(
+            "graphs", [f"graph_data:{spec.graph_title}" for spec in explained] + ["user_info"],
+            lambda *values: llm("graphs", _complete_or_none(agenerate_graph_explanations(list(values[:-1]), values[-1], budget))),
+            cacheable=True,
+            encode=lambda results: [result.dict() for result in results],
+            decode=lambda data: [GraphExplanation(**item) for item in data],
+            version=_stage_version("graph_batch")
+        ))
+    else:
+        explanation_stages = [f"graph:{spec.graph_title}" for spec in explained]
+        for spec in explained:
+            stages.append(PipelineStage(
+                f"graph:{spec.graph_title}", [f"graph_data:{spec.graph_title}", "user_info"],
+                lambda graph, info, span=f"graph:{spec.graph_title}": llm(span, agenerate_graph_explanation(
+                    graph["graph_title"], graph["x_variable"], graph["y_variable"], graph["data"], info, budget
+                )),
+                cacheable=True, encode=lambda result: result.dict(), decode=lambda data: GraphExplanation(**data),
+                version=_stage_version("graph")
+            ))
+
+    def final(category_result, brand_result, *values):
+        *explanations, info = values
+        if combined_graph_explanations and explained:
+            explanations = explanations[0]
+        return llm("final", agenerate_final_financial_advice(category_result, brand_result, list(explanations), info, budget))
+
+    stages.append(PipelineStage(
+        "final", ["category", "brand"] + explanation_stages + ["user_info"], final,
+        cacheable=True, encode=lambda result: result.dict(), decode=lambda data: FinalFinancialAdvice(**data),
+        version=_stage_version("final")
+    ))
+    return stages
+
+async def astream_financial_advice(
+    username: str,
+    max_concurrency: int = REPORT_MAX_CONCURRENCY,
+    time_budget: float = REPORT_TIME_BUDGET_SECONDS,
+    incremental: bool = INCREMENTAL_REPORTS,
+    force_refresh: bool = False,
+    include_metrics: bool = REPORT_METRICS
+):
+    """
+    Generates the financial report for a user, yielding each section as soon as it is ready.
+
+    Every record is {"seq": n, "section": type, "data": ...}. Sections arrive as their stages
+    finish: 'graph_data' (one per graph; graphs that don't need brand/category extraction come
+    first), 'category_analysis', 'brand_analysis' and one 'graph_explanation' per explained
+    graph (a graph's explanation may arrive before other graphs' data), then 'final_advice'. The last record is always 'report' with the
+    complete result (None if the user's data could not be loaded); a stage failure is announced
+    by an 'error' record just before it.
+
+    The stages form a DAG (see `build_report_stages`): the category analysis, brand analysis
+    and graph explanations only depend on the extracted products, so they run concurrently
+    (at most `max_concurrency` LLM calls in flight), and the final advice is requested once
+    all of them have finished. Each stage's result is kept in `stage_cache` under a hash of its
+    inputs, so a rerun only recomputes stages whose inputs changed (a budget change reruns the
+    LLM stages but not extraction; a graph whose data did not change keeps its explanation).
+
+    Every LLM call retries according to RETRY_POLICIES within an overall `time_budget`
+    (seconds). If a stage gives up, the report is a failure report carrying an 'error' entry.
+
+    With `incremental`, only events added since the previous report are fetched and
+    classified (see `update_report_state`).
+
+    Finished reports are cached under a fingerprint of the user's goals, budget and events
+    (see `compute_report_fingerprint`; incremental reports use the state's checkpoint instead,
+    see `compute_incremental_fingerprint`, so no event is read when nothing changed); `force_refresh` skips the report and stage cache
+    lookups and regenerates.
+
+    With COMBINED_GRAPH_EXPLANATIONS, all graphs are explained by one call (see
+    `agenerate_graph_explanations`) and their records arrive together.
+
+    Each stage runs in a metrics span (fetch, extraction, category, brand, graph:<title> or
+    graphs, final). The summary is added to the process totals (exported to METRICS_FILE) and, with
+    `include_metrics`, attached to the report under 'metrics'.
+    """
+    sequence = itertools.count()
+
+    def record(section, data):
+        return {"seq": next(sequence), "section": section, "data": data}
+
+    budget = ReportBudget(time_budget)
+    metrics = ReportMetrics()
+    try:
+        with metrics.span("fetch"):
+            user_id, user_info = await asyncio.to_thread(fetch_user, username)
+
+            # An unchanged user (same goals, budget and events) gets their previous report back
+            fingerprint = None
+            cached_report = None
+            if report_cache.ttl:
+                fetch_fingerprint = fetch_incremental_fingerprint if incremental else fetch_report_fingerprint
+                fingerprint = await asyncio.to_thread(fetch_fingerprint, user_id, user_info)
+                if fingerprint is not None and not force_refresh:
+                    cached_report = report_cache.get(fingerprint)
+
+            if cached_report is None and not incremental:
+                products = await asyncio.to_thread(fetch_products, user_id)
+
+        if cached_report is None and incremental:
+            with metrics.span("extraction"):
+                products, datasets = await asyncio.to_thread(update_report_state, user_id, budget)
+            if report_cache.ttl:
+                # The state now covers every event, so this fingerprint identifies the report
+                fingerprint = await asyncio.to_thread(fetch_incremental_fingerprint, user_id, user_info)
+    except ValueError as ve:
+        # print(ve)
+        yield record("report", None)
+        return
+    except Exception as e:
+        # print(f"An error occurred while fetching data for user '{username}': {e}")
+        yield record("report", None)
+        return
+
+    if cached_report is not None:
+        for section, data in _report_sections(cached_report):
+            yield record(section, data)
+        yield record("report", _finish_report(cached_report, metrics, include_metrics))
+        return
+
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    stages = build_report_stages(user_info, budget, metrics, semaphore, datasets if incremental else None)
+    explained_specs = [spec for spec in GRAPH_SPECS if spec.explain]
+    graph_data = {}
+    explanations = {}
+    category_result = None
+    brand_result = None
+    final_advice = None
+    stage_results = run_stage_graph(
+        stages, {"user_info": user_info, "products": products},
+        cache=stage_cache if stage_cache.ttl else None, refresh=force_refresh
+    )
+    try:
+        async for name, result, cached in stage_results:
+            if result is None:
+                continue
+            if name.startswith("graph_data:"):
+                graph_data[result["graph_title"]] = result
+                yield record("graph_data", _graph_data_section(result))
+            elif name == "category":
+                category_result = result
+                yield record("category_analysis", result.dict())
+            elif name == "brand":
+                brand_result = result
+                yield record("brand_analysis", result.dict())
+            elif name.startswith("graph:") or name == "graphs":
+                # Keyed by the graph's own title; the LLM may echo it back differently
+                titles = [spec.graph_title for spec in explained_specs] if name == "graphs" else [name[len("graph:"):]]
+                for title, explanation in zip(titles, result if name == "graphs" else [result]):
+                    explanations[title] = explanation
+                    yield record("graph_explanation", _graph_explanation_section(explanation))
+            elif name == "final":
+                final_advice = result
+                yield record("final_advice", result.dict())
+    finally:
+        # Cancels stages still running if the consumer stopped early
+        await stage_results.aclose()
+
+    graphs = [graph_data[spec.graph_title] for spec in GRAPH_SPECS if spec.graph_title in graph_data]
+    graph_explanations = [explanations.get(spec.graph_title) for spec in explained_specs]
+    if budget.failures or final_advice is None:
+        failure = budget.failures[0] if budget.failures else LLMStageError("final", "no result", 0)
+        yield record("error", failure.to_dict())
+        failure_report = build_failure_report(
+            failure, user_info, graphs, category_result, brand_result, graph_explanations, final_advice
+        )
+        yield record("report", _finish_report(failure_report, metrics, include_metrics))
+        return
+
+    report = build_report(category_result, brand_result, graph_explanations, final_advice, user_info, graphs)
+    if fingerprint is not None:
+        report_cache.set(fingerprint, report)
+    yield record("report", _finish_report(report, metrics, include_metrics))
+
+async def agenerate_financial_advice(
+    username: str,
+    max_concurrency: int = REPORT_MAX_CONCURRENCY,
+    time_budget: float = REPORT_TIME_BUDGET_SECONDS,
+    incremental: bool = INCREMENTAL_REPORTS,
+    force_refresh: bool = False,
+    include_metrics: bool = REPORT_METRICS
+):
+    """
+    Generates the full financial report for a user (see `astream_financial_advice`).
+
+    Returns:
+        dict: The report, or None if the user's data could not be loaded.
+    """
+    report = None
+    async for section in astream_financial_advice(
+        username, max_concurrency, time_budget, incremental, force_refresh, include_metrics
+    ):
+        if section["section"] == "report":
+            report = section["data"]
+    return report
+
+def stream_financial_advice(username: str, **kwargs):
+    """Synchronous generator over the records of `astream_financial_advice`."""
+    loop = asyncio.new_event_loop()
+    sections = astream_financial_advice(username, **kwargs)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(sections.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(sections.aclose())
+        loop.close()
+
+# Adjusted main function
+def generate_financial_advice(
+    username: str,
+    max_concurrency: int = REPORT_MAX_CONCURRENCY,
+    time_budget: float = REPORT_TIME_BUDGET_SECONDS,
+    incremental: bool = INCREMENTAL_REPORTS,
+    force_refresh: bool = False,
+    include_metrics: bool = REPORT_METRICS
+):
+    return asyncio.run(agenerate_financial_advice(
+        username, max_concurrency, time_budget, incremental, force_refresh, include_metrics
+    ))
 
     # # Output the results
     # print("*** Category-Based Analysis ***\n")
@@ -564,11 +3523,278 @@ def generate_financial_advice(username: str):
 
     # print("\nThank you for using our financial advisory service.")
 
-if __name__ == "__main__":
-    username_to_query = sys.argv[1] if len(sys.argv) > 1 else "M. McFly"
-    result = generate_financial_advice(username_to_query)
+# Bulk precompute: generate reports for many users across a worker pool
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", "4"))
+BULK_CHECKPOINT_PATH = os.getenv(
+    "BULK_CHECKPOINT_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "bulk_precompute.checkpoint")
+)
+
+def select_usernames(query: Optional[Dict[str, Any]] = None) -> List[str]:
+    """Usernames of every user matching `query` (all users when it is None)."""
+    users = get_users_collection().find(query or {}, {'username': 1})
+    return [user['username'] for user in users if user.get('username')]
+
+def _load_bulk_checkpoint(path: str) -> set:
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as checkpoint:
+        return {line.rstrip("\n") for line in checkpoint if line.strip()}
+
+def _bulk_report_writer(output: str):
+    # '*.jsonl' outputs append to a file; anything else names a MongoDB collection
+    lock = threading.Lock()
+    if output.endswith(".jsonl"):
+        def write(username, report):
+            line = json.dumps({"username": username, "report": report, "generatedAt": time.time()}, default=str)
+            with lock, open(output, "a") as reports_file:
+                reports_file.write(line + "\n")
+        return write
+
+    def write(username, report):
+        get_database()[output].replace_one(
+            {'username': username},
+            {'username': username, 'report': report, 'generatedAt': time.time()},
+            upsert=True
+        )
+    return write
+
+def run_bulk_precompute(
+    usernames: List[str],
+    workers: int = BULK_WORKERS,
+    output: str = "reports",
+    checkpoint_path: str = BULK_CHECKPOINT_PATH,
+    progress_stream=None,
+    **report_options
+) -> Dict[str, Any]:
+    """Synchronous entry point of `arun_bulk_precompute`."""
+    return asyncio.run(arun_bulk_precompute(usernames, workers, output, checkpoint_path, progress_stream, **report_options))
+
+async def arun_bulk_precompute(
+    usernames: List[str],
+    workers: int = BULK_WORKERS,
+    output: str = "reports",
+    checkpoint_path: str = BULK_CHECKPOINT_PATH,
+    progress_stream=None,
+    **report_options
+) -> Dict[str, Any]:
+    """
+    Generates reports for many users, at most `workers` at a time, as tasks on one event loop
+    (so they share the loop-bound LLM clients, like `serve`).
+
+    Reports are written to `output` (a '*.jsonl' file or a MongoDB collection name).
+    Every successfully written user is appended to `checkpoint_path`, and users already
+    listed there are skipped, so an interrupted run resumes where it stopped. Users whose
+    report failed are not checkpointed and are retried by the next run.
+
+    Returns:
+        dict: Counts, the failed users ({'username', 'error'}), elapsed time and throughput in
+        reports per minute.
+    """
+    progress_stream = progress_stream or sys.stderr
+    done = _load_bulk_checkpoint(checkpoint_path)
+    todo = [username for username in OrderedDict.fromkeys(usernames) if username not in done]
+    write_report = _bulk_report_writer(output)
+    checkpoint_lock = threading.Lock()
+    completed = 0
+    failed = []
+    started = time.perf_counter()
+
+    def save(username, report):
+        write_report(username, report)
+        if checkpoint_path:
+            with checkpoint_lock, open(checkpoint_path, "a") as checkpoint:
+                checkpoint.write(username + "\n")
+
+    async def generate(username) -> Optional[str]:
+        # Returns why the user's report failed, or None once it is written
+        report = await agenerate_financial_advice(username, **report_options)
+        if report is None:
+            return "user data could not be loaded"
+        if report.get("error"):
+            failure = report["error"]
+            return f"{failure['stage']} stage: {failure['reason']}"
+        await asyncio.to_thread(save, username, report)
+        return None
+
+    remaining = iter(todo)
+
+    async def worker():
+        nonlocal completed
+        # Workers pull users one at a time so huge user lists don't pile up tasks
+        for username in remaining:
+            try:
+                error = await generate(username)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            if error is None:
+                completed += 1
+            else:
+                failed.append({"username": username, "error": error})
+            elapsed = time.perf_counter() - started
+            progress_stream.write(
+                f"[bulk] {completed + len(failed)}/{len(todo)} users, {len(failed)} failed, "
+                f"{completed / elapsed * 60 if elapsed else 0.0:.1f} reports/min"
+                + (f" ({username} failed: {error})" if error is not None else "") + "\n"
+            )
+            progress_stream.flush()
+
+    await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+
+    elapsed = time.perf_counter() - started
+    return {
+        "users": len(usernames),
+        "skipped": len(usernames) - len(todo),
+        "completed": completed,
+        "failed": failed,
+        "elapsed_seconds": elapsed,
+        "reports_per_minute": completed / elapsed * 60 if elapsed else 0.0
+    }
+
+# Resident worker mode: one process serves many reports with warm clients and caches
+WORKER_MAX_CONCURRENT_REPORTS = int(os.getenv("WORKER_MAX_CONCURRENT_REPORTS", "4"))
+
+async def _handle_worker_request(line: str, semaphore, write_response):
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+    except ValueError as e:
+        write_response({"id": None, "ok": False, "error": f"invalid request: {e}"})
+        return
+
+    request_id = request.get("id") or uuid.uuid4().hex
+    op = request.get("op", "report")
+    if op == "ping":
+        write_response({"id": request_id, "ok": True, "result": "pong"})
+        return
+    if op == "stats":
+        write_response({"id": request_id, "ok": True, "result": {
+            "extraction_cache": extraction_cache.stats(),
+            "local_classifier": local_classifier.stats(),
+            "similarity_index": similarity_index.stats(),
+            "report_cache": report_cache.stats(),
+            "stage_cache": stage_cache.stats()
+        }})
+        return
+    if op != "report" or not isinstance(request.get("username"), str):
+        write_response({"id": request_id, "ok": False, "error": "expected {\"op\": \"report\", \"username\": ...}"})
+        return
+
+    started = time.perf_counter()
+    try:
+        async with semaphore:
+            result = await agenerate_financial_advice(
+                request["username"],
+                force_refresh=bool(request.get("force_refresh")),
+                include_metrics=bool(request.get("metrics", REPORT_METRICS))
+            )
+    except Exception as e:
+        write_response({"id": request_id, "ok": False, "error": f"{type(e).__name__}: {e}"})
+        return
+
+    response = {"id": request_id, "ok": result is not None, "elapsed_seconds": time.perf_counter() - started}
+    if result is None:
+        response["error"] = f"No report could be generated for user '{request['username']}'"
+    else:
+        response["result"] = result
+    write_response(response)
+
+async def serve(input_stream=None, output_stream=None, max_concurrent_reports: int = WORKER_MAX_CONCURRENT_REPORTS):
+    """
+    Runs a long-lived worker speaking newline-delimited JSON over stdin/stdout.
+
+    Each input line is a request such as {"id": "42", "op": "report", "username": "M. McFly"}
+    ("op" defaults to "report"; "ping" and "stats" are also understood; reports accept
+    optional "force_refresh" and "metrics" flags). Each output line is
+    {"id": ..., "ok": true, "result": {...}} or {"id": ..., "ok": false, "error": "..."}.
+    Requests are handled concurrently (up to `max_concurrent_reports` reports at once), so
+    responses may arrive out of order and must be matched by id. The LLM client, MongoDB
+    connection pool and caches stay warm for the lifetime of the process. EOF stops the worker
+    once in-flight reports have been answered.
+    """
+    input_stream = input_stream or sys.stdin
+    output_stream = output_stream or sys.stdout
+    semaphore = asyncio.Semaphore(max(1, max_concurrent_reports))
+    loop = asyncio.get_running_loop()
+    pending = set()
+
+    def write_response(response):
+        output_stream.write(json.dumps(response) + "\n")
+        output_stream.flush()
+
+    while True:
+        line = await loop.run_in_executor(None, input_stream.readline)
+        if not line:
+            break
+        if not line.strip():
+            continue
+        task = asyncio.create_task(_handle_worker_request(line, semaphore, write_response))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    if pending:
+        await asyncio.gather(*pending)
+
+# Seconds spent importing this module, reported by `--import-time`
+IMPORT_TIME_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a personalized financial report for a user.")
+    parser.add_argument("username", nargs="?", default="M. McFly", help="Username to generate the report for")
+    parser.add_argument("--import-time", action="store_true", help="Print how long importing this module took and exit")
+    parser.add_argument("--serve", action="store_true", help="Run as a resident worker reading NDJSON report requests from stdin")
+    parser.add_argument("--force-refresh", action="store_true", help="Regenerate the report even if a cached one matches")
+    parser.add_argument("--stream", action="store_true", help="Print each report section as an NDJSON record as soon as it is ready, then the full report")
+    parser.add_argument("--metrics", action="store_true", default=REPORT_METRICS, help="Attach per-stage timing, call and token metrics to the report")
+    parser.add_argument("--metrics-file", help="Rewrite this file with Prometheus text-format metrics after every report")
+    bulk = parser.add_mutually_exclusive_group()
+    bulk.add_argument("--bulk-users", nargs="+", metavar="USERNAME", help="Precompute reports for these users")
+    bulk.add_argument("--bulk-query", metavar="JSON", help="Precompute reports for users matching this MongoDB query")
+    bulk.add_argument("--bulk-all", action="store_true", help="Precompute reports for every user")
+    parser.add_argument("--workers", type=int, default=BULK_WORKERS, help="Bulk mode: number of reports generated in parallel")
+    parser.add_argument("--output", default="reports", help="Bulk mode: a *.jsonl file or a MongoDB collection name")
+    parser.add_argument("--checkpoint", default=BULK_CHECKPOINT_PATH, help="Bulk mode: file listing finished users, used to resume")
+    args = parser.parse_args(argv)
+
+    if args.import_time:
+        print(json.dumps({"import_time_seconds": IMPORT_TIME_SECONDS}))
+        return
+
+    if args.metrics_file:
+        global METRICS_FILE
+        METRICS_FILE = args.metrics_file
+
+    if args.serve:
+        asyncio.run(serve())
+        return
+
+    if args.bulk_users or args.bulk_query or args.bulk_all:
+        usernames = args.bulk_users or select_usernames(json.loads(args.bulk_query) if args.bulk_query else None)
+        summary = run_bulk_precompute(
+            usernames,
+            workers=args.workers,
+            output=args.output,
+            checkpoint_path=args.checkpoint,
+            force_refresh=args.force_refresh,
+            include_metrics=args.metrics
+        )
+        print(json.dumps(summary))
+        return
+
+    if args.stream:
+        # Sections go out as records; the complete report is printed bare as the last line, so
+        # "last JSON line" consumers (server/utils/categoryExtractor.js) keep working
+        for section in stream_financial_advice(args.username, force_refresh=args.force_refresh, include_metrics=args.metrics):
+            print(json.dumps(section["data"] if section["section"] == "report" else section), flush=True)
+        return
+
+    result = generate_financial_advice(args.username, force_refresh=args.force_refresh, include_metrics=args.metrics)
     print(json.dumps(result))
 
+if __name__ == "__main__":
+    main()
+
 """
 def generate_graphs_and_explanations():
     products = fetch_products()
@@ -0,0 +1,280 @@
+"""
+Offline benchmark for ai_agents.py.
+
+Runs the full report pipeline against a deterministic fake chat model and synthetic
+users/productevents held in an in-memory MongoDB stand-in (mongomock), so changes can be
+measured without Groq quota or a live database. Each scenario reports end-to-end latency,
+LLM call counts and peak Python memory, and fails when a call-count budget is exceeded.
+
+Usage:
+    python benchmark_ai_agents.py [--events 10,100,1000,10000] [--latency 0.05]
+                                  [--failure-rate 0] [--seed 7] [--json results.json]
+"""
+import os
+import sys
+import argparse
+import asyncio
+import json
+import random
+import re
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+# Isolate the benchmark from the real caches and from the production rate limits
+_BENCHMARK_DIR = tempfile.mkdtemp(prefix="ai_agents_benchmark_")
+os.environ.setdefault("EXTRACTION_CACHE_PATH", os.path.join(_BENCHMARK_DIR, "extraction_cache.sqlite3"))
+os.environ.setdefault("REPORT_CACHE_PATH", os.path.join(_BENCHMARK_DIR, "report_cache.sqlite3"))
+os.environ.setdefault("LLM_REQUESTS_PER_MINUTE", "0")
+os.environ.setdefault("LLM_TOKENS_PER_MINUTE", "0")
+os.environ.setdefault("LLM_RETRY_BASE_DELAY", "0.01")
+os.environ.setdefault("LLM_RETRY_MAX_DELAY", "0.05")
+
+import ai_agents
+
+# Catalog the synthetic titles are drawn from: brand -> (category, product nouns)
+CATALOG = {
+    "Logitech": ("Electronics", ["Wireless Mouse", "Mechanical Keyboard", "HD Webcam", "Gaming Headset"]),
+    "Samsung": ("Electronics", ["Galaxy Phone Case", "SSD 1TB", "Curved Monitor", "Earbuds"]),
+    "Ninja": ("Home Appliances", ["Blender", "Air Fryer", "Coffee Maker", "Food Processor"]),
+    "KitchenAid": ("Home Appliances", ["Stand Mixer", "Hand Mixer", "Toaster", "Kettle"]),
+    "Nike": ("Apparel", ["Running Shoes", "Hoodie", "Training Shorts", "Sports Socks"]),
+    "Levi's": ("Apparel", ["Slim Jeans", "Denim Jacket", "Leather Belt", "T-Shirt"]),
+    "Lego": ("Toys", ["Star Wars Set", "Technic Car", "City Fire Station", "Creator Kit"]),
+    "Penguin": ("Books", ["Classic Novel", "Cookbook", "Biography", "Poetry Collection"]),
+    "Olay": ("Beauty", ["Face Moisturizer", "Night Cream", "Eye Serum", "Cleanser"]),
+    "Coleman": ("Outdoors", ["Camping Tent", "Sleeping Bag", "Lantern", "Cooler"]),
+}
+PLATFORMS = ["Amazon", "Target", "eBay", "Walmart", "Best Buy"]
+CATEGORY_BY_BRAND = {brand: category for brand, (category, _) in CATALOG.items()}
+
+class FakeLLMError(Exception):
+    """Transient failure injected by FakeChatModel; carries a 503 so the pipeline retries it."""
+
+    status_code = 503
+
+class FakeMessage:
+    def __init__(self, content: str):
+        self.content = content
+
+class FakeChatModel:
+    """
+    Stand-in for ChatGroq that answers every prompt of the pipeline with a valid payload.
+
+    Brands and categories are read back from the synthetic titles, so results are deterministic.
+    Each call sleeps `latency` seconds and fails with probability `failure_rate`.
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.failures = 0
+
+    def with_structured_output(self, schema, **kwargs):
+        return FakeStructuredModel(self, schema)
+
+    def _start_call(self, name: str) -> None:
+        self.calls[name] += 1
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.failures += 1
+            raise FakeLLMError(f"injected failure in {name}")
+
+    def _respond(self, prompt: str):
+        self._start_call("raw")
+        name = re.search(r'Product Name: "(.*)"', prompt).group(1)
+        return FakeMessage(json.dumps(dict(productName=name, **classify_title(name))))
+
+    def invoke(self, prompt, config=None, **kwargs):
+        time.sleep(self.latency)
+        return self._respond(prompt)
+
+    async def ainvoke(self, prompt, config=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._respond(prompt)
+
+class FakeStructuredModel:
+    def __init__(self, model: FakeChatModel, schema):
+        self.model = model
+        self.schema = schema
+
+    def _respond(self, prompt: str):
+        self.model._start_call(self.schema.__name__)
+        return self.schema(**fake_payload(self.schema.__name__, prompt))
+
+    def invoke(self, prompt, config=None, **kwargs):
+        time.sleep(self.model.latency)
+        return self._respond(prompt)
+
+    async def ainvoke(self, prompt, config=None, **kwargs):
+        await asyncio.sleep(self.model.latency)
+        return self._respond(prompt)
+
+def classify_title(title: str):
+    brand = next((brand for brand in CATALOG if title.startswith(brand)), title.split()[0])
+    return {"productBrand": brand, "productCategory": CATEGORY_BY_BRAND.get(brand, "Miscellaneous")}
+
+def fake_payload(schema_name: str, prompt: str):
+    if schema_name == "BrandCategoryExtractionOutput":
+        name = re.search(r'Product Name: "(.*)"', prompt).group(1)
+        return dict(productName=name, **classify_title(name))
+    if schema_name == "BrandCategoryExtractionBatch":
+        names = re.findall(r"^\d+\. (.*)$", prompt, re.M)
+        return {"products": [dict(productName=name, **classify_title(name)) for name in names]}
+    if schema_name == "ProductCategoryDescriptions":
+        return {"categories": [
+            {"category_name": category, "products": [{"product_name": f"{category} purchases", "description": "Regular spending."}]}
+            for category in sorted(set(CATEGORY_BY_BRAND.values())) if category in prompt
+        ]}
+    if schema_name == "BrandDescriptions":
+        return {"brands": [
+            {"brand_name": brand, "products": [{"product_name": f"{brand} products", "description": "Frequent purchases."}]}
+            for brand in CATALOG if brand in prompt
+        ]}
+    if schema_name == "GraphExplanation":
+        title = re.search(r"Graph Title: (.*)", prompt).group(1).strip()
+        return {"graph_title": title, "explanation": "Spending is concentrated in a few groups."}
+    if schema_name == "GraphExplanationBatch":
+        return {"explanations": [
+            {"graph_title": title.strip(), "explanation": "Spending is concentrated in a few groups."}
+            for title in re.findall(r"Graph Title: (.*)", prompt)
+        ]}
+    if schema_name == "FinalFinancialAdvice":
+        return {"summary": "Spending is within budget.", "recommendations": ["Set a monthly cap for electronics."]}
+    raise ValueError(f"FakeChatModel has no payload for {schema_name}")
+
+def generate_synthetic_data(database, username: str, events: int, seed: int = 0):
+    """
+    Inserts one user and `events` product events into `database`.
+
+    Titles repeat the way real browsing does: most events revisit a small set of products, with
+    a long tail of variants (sizes, colours) that only show up once or twice.
+    """
+    rng = random.Random(seed)
+    user_id = database["users"].insert_one({
+        "username": username,
+        "email": f"{username}@example.com",
+        "password": "benchmark",
+        "goals": ["Save for a house", "Spend less on gadgets"],
+        "budget": 2500
+    }).inserted_id
+
+    titles = [f"{brand} {noun}" for brand, (_, nouns) in CATALOG.items() for noun in nouns]
+    started = datetime(2024, 1, 1)
+    documents = []
+    for index in range(events):
+        title = rng.choice(titles)
+        if rng.random() < 0.2:
+            title = f"{title} - Variant {rng.randint(1, max(1, events // 20))}"
+        documents.append({
+            "userId": user_id,
+            "sessionId": f"session-{index // 25}",
+            "timestamp": started + timedelta(minutes=index),
+            "platform": rng.choice(PLATFORMS),
+            "productUrl": f"https://shop.example.com/{re.sub(r'[^a-z0-9]+', '-', title.lower())}",
+            "productTitle": title,
+            "price": round(rng.uniform(5, 400), 2)
+        })
+    if documents:
+        database["productevents"].insert_many(documents)
+    return user_id
+
+# Maximum LLM calls per report (cold caches, no injected failures); regressions fail the run
+CALL_BUDGETS = {10: 9, 100: 9, 1000: 16, 10000: 28}
+
+def _install_fakes(model: FakeChatModel):
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("benchmark_ai_agents.py needs mongomock for its in-memory MongoDB (pip install mongomock)")
+
+    client = mongomock.MongoClient()
+    ai_agents.get_mongo_client = lambda: client
+    ai_agents.get_llm = lambda route=None: model
+    ai_agents.get_structured_llm.cache_clear()
+    return client
+
+def _reset_caches(name: str):
+    # Cold caches per scenario so runs do not feed each other
+    ai_agents.extraction_cache = ai_agents.PersistentLRUCache(
+        os.path.join(_BENCHMARK_DIR, f"{name}-extraction.sqlite3"), "brand_category_extractions"
+    )
+    ai_agents.local_classifier = ai_agents.LocalBrandClassifier(os.path.join(_BENCHMARK_DIR, f"{name}-extraction.sqlite3"))
+    ai_agents.similarity_index = ai_agents.TitleSimilarityIndex(os.path.join(_BENCHMARK_DIR, f"{name}-extraction.sqlite3"))
+    ai_agents.stage_cache = ai_agents.PersistentLRUCache(
+        os.path.join(_BENCHMARK_DIR, f"{name}-report.sqlite3"), "stage_results", ttl=ai_agents.STAGE_CACHE_TTL_SECONDS or None
+    )
+    ai_agents.report_cache = ai_agents.PersistentLRUCache(
+        os.path.join(_BENCHMARK_DIR, f"{name}-report.sqlite3"), "reports", ttl=ai_agents.REPORT_CACHE_TTL_SECONDS or None
+    )
+
+def _measure(username: str, model: FakeChatModel, force_refresh: bool = False):
+    model.calls.clear()
+    tracemalloc.start()
+    started = time.perf_counter()
+    report = ai_agents.generate_financial_advice(username, force_refresh=force_refresh)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "seconds": round(elapsed, 4),
+        "llm_calls": sum(model.calls.values()),
+        "calls_by_schema": dict(model.calls),
+        "peak_memory_mb": round(peak / 2 ** 20, 2),
+        "failed": report is None or "error" in report
+    }
+
+def run_scenario(events: int, latency: float, failure_rate: float, seed: int):
+    """Benchmarks one report over `events` synthetic events, cold and then with warm caches."""
+    model = FakeChatModel(latency=latency, failure_rate=failure_rate, seed=seed)
+    client = _install_fakes(model)
+    username = f"benchmark-{events}"
+    generate_synthetic_data(client["ecommerce_tracker"], username, events, seed)
+    _reset_caches(username)
+
+    cold = _measure(username, model)
+    warm = _measure(username, model, force_refresh=True)
+    cached = _measure(username, model)
+    result = {"events": events, "cold": cold, "warm_extraction_cache": warm, "cached_report": cached}
+
+    budget = CALL_BUDGETS.get(events)
+    result["call_budget"] = budget
+    # Injected failures add retries, so budgets only hold for failure-free runs
+    result["within_budget"] = budget is None or failure_rate > 0 or (cold["llm_calls"] <= budget and cached["llm_calls"] == 0)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ai_agents.py offline with a fake LLM and synthetic data")
+    parser.add_argument("--events", default=",".join(str(events) for events in CALL_BUDGETS), help="Comma-separated event counts, one scenario each")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the fake model takes per call")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability that a fake model call fails with a retryable error")
+    parser.add_argument("--seed", type=int, default=7, help="Seed for the synthetic data and injected failures")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    for events in (int(value) for value in args.events.split(",") if value.strip()):
+        result = run_scenario(events, args.latency, args.failure_rate, args.seed)
+        results.append(result)
+        cold = result["cold"]
+        print(
+            f"{events:>6} events  cold {cold['seconds']:>7.3f}s {cold['llm_calls']:>3} calls "
+            f"(budget {result['call_budget']})  {cold['peak_memory_mb']:>7.2f} MB peak  "
+            f"warm {result['warm_extraction_cache']['seconds']:.3f}s {result['warm_extraction_cache']['llm_calls']} calls  "
+            f"cached {result['cached_report']['seconds']:.3f}s"
+            + ("" if result["within_budget"] else "  OVER BUDGET"),
+            flush=True
+        )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+    if not all(result["within_budget"] for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
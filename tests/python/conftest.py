@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# ai_agents opens its caches at import time; keep them out of the repository
+_CACHE_DIR = tempfile.mkdtemp(prefix="ai_agents_tests_")
+os.environ.setdefault("EXTRACTION_CACHE_PATH", os.path.join(_CACHE_DIR, "extraction_cache.sqlite3"))
+os.environ.setdefault("REPORT_CACHE_PATH", os.path.join(_CACHE_DIR, "report_cache.sqlite3"))
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
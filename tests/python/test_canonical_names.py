@@ -0,0 +1,35 @@
+import pytest
+
+from ai_agents import CanonicalAliasStore, CanonicalNames
+
+
+@pytest.fixture
+def aliases(tmp_path):
+    return CanonicalAliasStore(str(tmp_path / "aliases.sqlite3"))
+
+
+def test_spelling_variants_merge(aliases):
+    categories = CanonicalNames("category", ["Jewelery", "Electronic Accessories"], aliases=aliases)
+    assert categories.resolve("Jewelry") == "Jewelery"
+    assert categories.resolve("Electronics Accessory") == "Electronic Accessories"
+    assert aliases.get("category", "jewelry") == "Jewelery"
+
+
+def test_added_or_changed_word_stays_separate(aliases):
+    categories = CanonicalNames("category", ["Men's Clothing", "Home & Kitchen"], aliases=aliases)
+    assert categories.resolve("Women's Clothing") == "Women's Clothing"
+    assert categories.resolve("Home and Kitchen Tools") == "Home and Kitchen Tools"
+    assert aliases.get("category", "women clothing") is None
+
+
+def test_persisted_merge_of_different_words_is_ignored(aliases):
+    aliases.set("category", "women clothing", "Men's Clothing")
+    categories = CanonicalNames("category", ["Men's Clothing"], aliases=aliases)
+    assert categories.resolve("Women's Clothing") == "Women's Clothing"
+
+
+def test_synonyms_merge(aliases):
+    categories = CanonicalNames("category", ["Clothing"], aliases=aliases)
+    assert categories.resolve("Fashion") == "Clothing"
+    # Later runs reuse the persisted merge even before "Clothing" shows up
+    assert CanonicalNames("category", aliases=aliases).resolve("fashion") == "Clothing"
@@ -0,0 +1,55 @@
+import pytest
+
+import ai_agents
+from ai_agents import CanonicalNames, LocalBrandClassifier, PersistentLRUCache, TitleSimilarityIndex
+
+
+@pytest.fixture(autouse=True)
+def fresh_stores(tmp_path, monkeypatch):
+    path = str(tmp_path / "extraction.sqlite3")
+    monkeypatch.setattr(ai_agents, "extraction_cache", PersistentLRUCache(path, "brand_category_extractions"))
+    monkeypatch.setattr(ai_agents, "local_classifier", LocalBrandClassifier(path))
+    monkeypatch.setattr(ai_agents, "similarity_index", TitleSimilarityIndex(path))
+
+
+def _products(count):
+    return [
+        {"productName": f"Quixotic Widget Mk{index}", "ecommerceSite": "Amazon", "productPrice": 1.0, "productPurchased": True}
+        for index in range(count)
+    ]
+
+
+def _record_single_calls(monkeypatch, single_calls):
+    def single(product, categories, brands, budget=None):
+        single_calls.append(product["productName"])
+        return ai_agents.assign_brand_and_category(product, "Solo", "Gadgets", categories, brands)
+    monkeypatch.setattr(ai_agents, "extract_brand_and_category", single)
+
+
+def test_failed_batch_call_does_not_fan_out(monkeypatch):
+    single_calls = []
+    _record_single_calls(monkeypatch, single_calls)
+    monkeypatch.setattr(ai_agents, "extract_brand_and_category_batch", lambda names, categories, brands, budget=None: None)
+    products = _products(4)
+    ai_agents.extract_brands_and_categories(products, CanonicalNames("category"), CanonicalNames("brand"), batch_size=2)
+
+    assert single_calls == []
+    assert {(product["productBrand"], product["productCategory"]) for product in products} == {("Unknown", "Miscellaneous")}
+    # Left uncached so the next run asks again
+    assert ai_agents.extraction_cache.get("quixotic widget mk0") is None
+
+
+def test_titles_missing_from_the_response_are_classified_alone(monkeypatch):
+    single_calls = []
+    _record_single_calls(monkeypatch, single_calls)
+    monkeypatch.setattr(
+        ai_agents, "extract_brand_and_category_batch",
+        lambda names, categories, brands, budget=None: {
+            ai_agents.normalize_product_title(names[0]): {"productBrand": "Quixotic", "productCategory": "Gadgets"}
+        }
+    )
+    products = _products(2)
+    ai_agents.extract_brands_and_categories(products, CanonicalNames("category"), CanonicalNames("brand"), batch_size=2)
+
+    assert [product["productBrand"] for product in products] == ["Quixotic", "Solo"]
+    assert single_calls == ["Quixotic Widget Mk1"]
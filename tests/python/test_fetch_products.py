@@ -0,0 +1,41 @@
+import datetime
+
+import pytest
+
+import ai_agents
+
+mongomock = pytest.importorskip("mongomock")
+
+# Titles differing only in case and spacing, with an empty or missing URL, are one listing
+EVENTS = [
+    ("  Foo   Bar ", ""),
+    ("foo bar", None),
+    ("FOO\tBAR", ""),
+    ("Foo Bar", "https://shop.example.com/foo"),
+    ("Foo Bar (renamed)", "https://shop.example.com/foo"),
+]
+
+
+@pytest.fixture
+def user_id(monkeypatch):
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(ai_agents, "get_mongo_client", lambda: client)
+    client["ecommerce_tracker"]["productevents"].insert_many([
+        dict(
+            {"userId": 1, "platform": "Amazon", "productTitle": title, "price": float(index + 1),
+             "timestamp": datetime.datetime(2024, 1, 1, index)},
+            **({"productUrl": url} if url is not None else {})
+        )
+        for index, (title, url) in enumerate(EVENTS)
+    ])
+    return 1
+
+
+@pytest.mark.parametrize("pushdown", [False, True])
+@pytest.mark.parametrize("columnar", [False, True])
+def test_pushdown_groups_like_listing_key(user_id, pushdown, columnar):
+    products = ai_agents.fetch_products(user_id, pushdown=pushdown, dedupe=True, columnar=columnar)
+    assert [(product["viewCount"], list(product["priceHistory"])) for product in products] == [
+        (3, [1.0, 2.0, 3.0]),
+        (2, [4.0, 5.0]),
+    ]
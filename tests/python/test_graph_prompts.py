@@ -0,0 +1,30 @@
+import ai_agents
+from ai_agents import GraphExplanation, PROMPT_TOKEN_BUDGET, build_graph_explanations_prompt, estimate_tokens
+
+USER_INFO = {"goals": ["Save for a house"], "budget": 1500}
+
+
+def _graph(title, data):
+    return {"graph_title": title, "x_variable": "Purchase", "y_variable": "Amount", "data": data}
+
+
+def test_values_datasets_are_summarized():
+    prices = [float(price % 400) + 0.99 for price in range(10000)]
+    prompt = build_graph_explanations_prompt([_graph("Purchase Amounts", {"purchase_prices": prices})], USER_INFO)
+    assert estimate_tokens(prompt) < PROMPT_TOKEN_BUDGET
+    assert '"count":10000' in prompt
+    assert '"min":0.99' in prompt and '"max":399.99' in prompt
+
+
+def test_oversized_prompt_skips_the_combined_call(monkeypatch):
+    def unexpected(*args, **kwargs):
+        raise AssertionError("the combined call should have been skipped")
+
+    monkeypatch.setattr(ai_agents, "invoke_with_retry", unexpected)
+    monkeypatch.setattr(
+        ai_agents, "generate_graph_explanation",
+        lambda title, x, y, data, info, budget=None: GraphExplanation(graph_title=title, explanation="one at a time")
+    )
+    brands = {f"Brand {index}": float(index) for index in range(5000)}
+    results = ai_agents.generate_graph_explanations([_graph("Spending by Brand", brands)], USER_INFO)
+    assert [result.explanation for result in results] == ["one at a time"]
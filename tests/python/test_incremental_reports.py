@@ -0,0 +1,120 @@
+import datetime
+
+import pytest
+
+import ai_agents
+
+mongomock = pytest.importorskip("mongomock")
+
+START = datetime.datetime(2024, 1, 1)
+
+
+def _classify(products, categories, brands, batch_size=None, budget=None):
+    # "<Brand> <Category> ..." titles, so results don't depend on an LLM
+    for product in products:
+        brand, category = product["productName"].split()[:2]
+        ai_agents.assign_brand_and_category(product, brand, category, categories, brands)
+    return products
+
+
+@pytest.fixture
+def database(monkeypatch):
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(ai_agents, "get_mongo_client", lambda: client)
+    monkeypatch.setattr(ai_agents, "extract_brands_and_categories", _classify)
+    return client["ecommerce_tracker"]
+
+
+def _insert(database, *events):
+    database["productevents"].insert_many([
+        {"userId": 1, "platform": site, "productTitle": title, "price": price,
+         "productUrl": f"https://shop.example.com/{title.lower().replace(' ', '-')}",
+         "timestamp": START + datetime.timedelta(minutes=minute)}
+        for site, title, price, minute in events
+    ])
+
+
+def _full_recompute():
+    products = _classify(ai_agents.fetch_products(1, pushdown=False, dedupe=True, columnar=False), [], [])
+    return ai_agents.aggregate_graph_datasets(products)
+
+
+def _assert_same_datasets(actual, expected):
+    for spec, got, want in zip(ai_agents.GRAPH_SPECS, actual, expected):
+        if spec.metric == "values":
+            assert sorted(got) == pytest.approx(sorted(want))
+        else:
+            assert got == pytest.approx(want)
+
+
+def test_incremental_update_matches_full_recompute(database):
+    _insert(database,
+            ("Amazon", "Acme Tools Hammer", 20.0, 0),
+            ("Amazon", "Acme Tools Hammer", 22.0, 1),
+            ("eBay", "Globex Garden Hose", 35.0, 2),
+            # Two events share the checkpoint's timestamp
+            ("eBay", "Globex Garden Rake", 15.0, 3),
+            ("Amazon", "Acme Tools Wrench", 12.0, 3))
+    ai_agents.update_report_state(1)
+
+    # Same timestamp as the checkpoint, but a later _id: must not be skipped
+    _insert(database,
+            ("Amazon", "Acme Tools Drill", 80.0, 3),
+            ("Amazon", "Acme Tools Hammer", 19.0, 4),
+            ("Walmart", "Globex Garden Hose", 30.0, 5))
+    products, datasets = ai_agents.update_report_state(1)
+
+    _assert_same_datasets(datasets, _full_recompute())
+    state = database["reportstates"].find_one({"_id": 1})
+    assert state["eventCount"] == 8
+    assert len(ai_agents.load_report_products(1)) == len(products) == 6
+    assert sum(len(product["priceHistory"]) for product in ai_agents.load_report_products(1)) == 8
+
+
+def test_only_touched_listings_are_written(database, monkeypatch):
+    _insert(database,
+            ("Amazon", "Acme Tools Hammer", 20.0, 0),
+            ("eBay", "Globex Garden Hose", 35.0, 1))
+    ai_agents.update_report_state(1)
+
+    saves = []
+    save = ai_agents.save_report_products
+    monkeypatch.setattr(
+        ai_agents, "save_report_products",
+        lambda user_id, products, replace=False: saves.append((replace, [p["productName"] for p in products])) or save(user_id, products, replace)
+    )
+    _insert(database, ("Amazon", "Acme Tools Hammer", 25.0, 2))
+    ai_agents.update_report_state(1)
+
+    assert saves == [(False, ["Acme Tools Hammer"])]
+    hammer = next(p for p in ai_agents.load_report_products(1) if p["productName"] == "Acme Tools Hammer")
+    assert hammer["priceHistory"] == [20.0, 25.0]
+
+
+def test_no_new_events_reuses_the_state(database, monkeypatch):
+    _insert(database, ("Amazon", "Acme Tools Hammer", 20.0, 0))
+    _, datasets = ai_agents.update_report_state(1)
+    monkeypatch.setattr(ai_agents, "save_report_products", lambda *args, **kwargs: pytest.fail("nothing to save"))
+    _, again = ai_agents.update_report_state(1)
+    _assert_same_datasets(again, datasets)
+
+
+def test_legacy_inline_products_are_migrated(database):
+    _insert(database,
+            ("Amazon", "Acme Tools Hammer", 20.0, 0),
+            ("eBay", "Globex Garden Hose", 35.0, 1))
+    products, datasets = ai_agents.update_report_state(1)
+    # Rewrite the state the way it was stored before products had their own collection
+    state = database["reportstates"].find_one({"_id": 1})
+    state["products"] = ai_agents.load_report_products(1)
+    database["reportstates"].replace_one({"_id": 1}, state)
+    database["reportproducts"].delete_many({})
+
+    _insert(database, ("Amazon", "Acme Tools Wrench", 12.0, 2))
+    products, datasets = ai_agents.update_report_state(1)
+
+    _assert_same_datasets(datasets, _full_recompute())
+    assert "products" not in database["reportstates"].find_one({"_id": 1})
+    assert sorted(p["productName"] for p in ai_agents.load_report_products(1)) == [
+        "Acme Tools Hammer", "Acme Tools Wrench", "Globex Garden Hose"
+    ]
@@ -0,0 +1,41 @@
+import pytest
+
+from ai_agents import LOCAL_CLASSIFIER_MIN_CONFIDENCE, LocalBrandClassifier
+
+
+@pytest.fixture
+def classifier(tmp_path):
+    return LocalBrandClassifier(str(tmp_path / "brands.sqlite3"))
+
+
+@pytest.mark.parametrize("title", [
+    "Logitech G Pro Wireless Gaming Mouse",
+    "Razer BlackWidow Gaming Keyboard",
+    "Samsung Odyssey G7 Gaming Monitor",
+    "Samsung Galaxy Watch Charger",
+])
+def test_tied_keywords_follow_the_brand(classifier, title):
+    result = classifier.classify(title)
+    assert result["productCategory"] == "Electronics"
+    assert result["confidence"] >= LOCAL_CLASSIFIER_MIN_CONFIDENCE
+
+
+def test_unresolved_tie_goes_to_the_llm(classifier):
+    # "gaming" and "watch" disagree, and neither is Samsung's usual category
+    result = classifier.classify("Samsung Gaming Watch")
+    assert result["confidence"] < LOCAL_CLASSIFIER_MIN_CONFIDENCE
+
+
+def test_brand_without_keyword_goes_to_the_llm(classifier):
+    result = classifier.classify("Apple Cider Vinegar")
+    assert result is None or result["confidence"] < LOCAL_CLASSIFIER_MIN_CONFIDENCE
+
+
+def test_brand_and_keyword_are_confident(classifier):
+    result = classifier.classify("Apple MacBook Air Laptop")
+    assert (result["productBrand"], result["productCategory"]) == ("Apple", "Electronics")
+    assert result["confidence"] >= LOCAL_CLASSIFIER_MIN_CONFIDENCE
+
+
+def test_longest_keyword_wins(classifier):
+    assert classifier.classify("Nike Air Zoom Running Shoes")["productCategory"] == "Footwear"
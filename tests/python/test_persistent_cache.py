@@ -0,0 +1,142 @@
+import sqlite3
+
+import pytest
+
+import ai_agents
+from ai_agents import CanonicalAliasStore, PersistentLRUCache, SQLiteTable
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache.sqlite3")
+
+
+def test_get_counts_hits_and_misses(path):
+    cache = PersistentLRUCache(path, "entries")
+    assert cache.get("missing") is None
+    cache.set("key", {"value": 1})
+    assert cache.get("key") == {"value": 1}
+    assert cache.get("key") == {"value": 1}
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (2, 1)
+    assert stats["hit_rate"] == pytest.approx(2 / 3)
+
+
+def test_values_survive_a_new_instance(path):
+    PersistentLRUCache(path, "entries").set("key", [1, 2, 3])
+    reopened = PersistentLRUCache(path, "entries")
+    assert reopened.get("key") == [1, 2, 3]
+    assert reopened.hits == 1
+
+
+def test_memory_layer_is_bounded(path):
+    cache = PersistentLRUCache(path, "entries", memory_entries=2)
+    for key in "abc":
+        cache.set(key, key)
+    assert cache.stats()["memory_entries"] == 2
+    # Evicted from memory, still served from disk
+    assert cache.get("a") == "a"
+
+
+def test_disk_layer_evicts_least_recently_used(path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ai_agents.time, "time", lambda: now[0])
+    monkeypatch.setattr(PersistentLRUCache, "EVICTION_INTERVAL", 5)
+    cache = PersistentLRUCache(path, "entries", max_entries=3, memory_entries=1)
+    for key in "abc":
+        now[0] += 1
+        cache.set(key, key)
+    now[0] += 1
+    assert cache.get("a") == "a"  # read from disk, refreshing its access time
+    for key in "de":
+        now[0] += 1
+        cache.set(key, key)
+
+    with sqlite3.connect(path) as conn:
+        keys = {key for (key,) in conn.execute("SELECT key FROM entries")}
+    assert keys == {"a", "d", "e"}
+
+
+def test_memory_hits_keep_keys_recent_on_disk(path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ai_agents.time, "time", lambda: now[0])
+    monkeypatch.setattr(PersistentLRUCache, "EVICTION_INTERVAL", 5)
+    cache = PersistentLRUCache(path, "entries", max_entries=3)
+    cache.set("hot", "hot")
+    for index in range(10):
+        now[0] += 1
+        cache.set(f"cold{index}", index)
+        now[0] += 1
+        assert cache.get("hot") == "hot"  # always served from memory
+
+    with sqlite3.connect(path) as conn:
+        keys = {key for (key,) in conn.execute("SELECT key FROM entries")}
+    assert "hot" in keys
+
+
+def test_access_times_are_flushed_periodically(path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ai_agents.time, "time", lambda: now[0])
+    cache = PersistentLRUCache(path, "entries")
+    cache.set("key", "value")
+    now[0] += PersistentLRUCache.ACCESS_FLUSH_SECONDS + 1
+    assert cache.get("key") == "value"
+    # Written without waiting for an eviction, so a restart keeps the key recent
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT accessed FROM entries").fetchone()[0] == now[0]
+
+
+def test_entries_expire_after_ttl(path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ai_agents.time, "time", lambda: now[0])
+    cache = PersistentLRUCache(path, "entries", ttl=60)
+    cache.set("key", "value")
+    now[0] += 30
+    assert cache.get("key") == "value"
+    now[0] += 31
+    assert cache.get("key") is None
+    # The disk row is expired too, not just the memory copy
+    assert PersistentLRUCache(path, "entries", ttl=60).get("key") is None
+    assert PersistentLRUCache(path, "entries").get("key") == "value"
+
+
+def test_expired_rows_are_deleted_on_eviction(path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ai_agents.time, "time", lambda: now[0])
+    monkeypatch.setattr(PersistentLRUCache, "EVICTION_INTERVAL", 2)
+    cache = PersistentLRUCache(path, "entries", ttl=60)
+    cache.set("old", 1)
+    now[0] += 120
+    cache.set("new", 2)
+    with sqlite3.connect(path) as conn:
+        assert [key for (key,) in conn.execute("SELECT key FROM entries")] == ["new"]
+
+
+def test_old_schema_is_migrated(path):
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed REAL NOT NULL)")
+        conn.execute("INSERT INTO entries VALUES ('key', '\"value\"', 0)")
+    cache = PersistentLRUCache(path, "entries")
+    assert cache.get("key") == "value"
+    cache.set("other", 1)
+    assert PersistentLRUCache(path, "entries").get("other") == 1
+
+
+def test_unusable_file_degrades_to_memory(tmp_path):
+    cache = PersistentLRUCache(str(tmp_path), "entries")
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    assert cache.get("missing") is None
+
+
+def test_sqlite_table_reports_failures(path):
+    table = SQLiteTable(path, "rows", "key TEXT PRIMARY KEY")
+    assert table.execute(("INSERT INTO {table} (key) VALUES (?)", ("a",)))
+    assert not table.execute(("INSERT INTO {table} (key) VALUES (?)", ("a",)))
+    assert table.fetch("SELECT key FROM {table}") == [("a",)]
+    assert table.fetch("SELECT missing FROM {table}") is None
+
+
+def test_alias_store_persists(path):
+    CanonicalAliasStore(path).set("category", "tech", "Electronics")
+    assert CanonicalAliasStore(path).get("category", "tech") == "Electronics"
@@ -0,0 +1,24 @@
+import pytest
+
+import ai_agents
+from ai_agents import LLMStageError, RateLimiter, ReportBudget
+
+
+def test_reservations_queue_callers():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=0)
+    waits = [limiter.reserve(100) for _ in range(62)]
+    assert waits[59] == 0.0
+    assert waits[60] > 0.0
+    assert waits[61] > waits[60]
+
+
+def test_call_over_budget_returns_its_reservation(monkeypatch):
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=1000)
+    monkeypatch.setattr(ai_agents, "rate_limiter", limiter)
+    assert limiter.reserve(900) == 0.0
+
+    with pytest.raises(LLMStageError):
+        ai_agents._rate_limit_wait("graph", "x" * 4000, 1, ReportBudget(0.5))
+
+    # The aborted call holds no capacity, so a small call still goes out immediately
+    assert limiter.reserve(50) == 0.0
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+import ai_agents
+from ai_agents import (
+    GraphExplanation, LLMStageError, ProductCategoryDescriptions, RateLimiter, ReportBudget, RetryPolicy,
+    ainvoke_with_retry, build_failure_report, invoke_with_retry
+)
+
+
+class FakeRunnable:
+    """Returns (or raises) the given outcomes in order, one per call."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def invoke(self, prompt, config=None):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def ainvoke(self, prompt, config=None):
+        return self.invoke(prompt, config)
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+@pytest.fixture(autouse=True)
+def no_waiting(monkeypatch):
+    monkeypatch.setattr(ai_agents, "rate_limiter", RateLimiter(requests_per_minute=0, tokens_per_minute=0))
+    monkeypatch.setitem(ai_agents.RETRY_POLICIES, "graph", RetryPolicy(max_attempts=3, base_delay=0, max_delay=0))
+
+
+@pytest.fixture(params=["sync", "async"])
+def invoke(request):
+    if request.param == "sync":
+        return invoke_with_retry
+    return lambda *args: asyncio.run(ainvoke_with_retry(*args))
+
+
+def test_retryable_errors_and_empty_responses_are_retried(invoke, monkeypatch):
+    monkeypatch.setitem(ai_agents.RETRY_POLICIES, "graph", RetryPolicy(max_attempts=4, base_delay=0, max_delay=0))
+    runnable = FakeRunnable(TimeoutError("slow"), StatusError(429), None, "answer")
+    assert invoke("graph", runnable, "prompt") == "answer"
+    assert runnable.calls == 4
+
+
+@pytest.mark.parametrize("error", [ValueError("bad request"), StatusError(400)])
+def test_non_retryable_error_fails_at_once(invoke, error):
+    runnable = FakeRunnable(error, "answer")
+    with pytest.raises(LLMStageError) as raised:
+        invoke("graph", runnable, "prompt")
+    assert raised.value.attempts == 1
+    assert runnable.calls == 1
+
+
+def test_attempts_are_capped_by_the_policy(invoke):
+    runnable = FakeRunnable(*[TimeoutError("slow")] * 5)
+    with pytest.raises(LLMStageError) as raised:
+        invoke("graph", runnable, "prompt")
+    assert (raised.value.stage, raised.value.attempts) == ("graph", 3)
+    assert runnable.calls == 3
+
+
+def test_spent_budget_stops_before_calling(invoke):
+    runnable = FakeRunnable("answer")
+    with pytest.raises(LLMStageError, match="budget exhausted"):
+        invoke("graph", runnable, "prompt", ReportBudget(0))
+    assert runnable.calls == 0
+
+
+def test_backoff_longer_than_the_budget_gives_up(invoke, monkeypatch):
+    monkeypatch.setitem(ai_agents.RETRY_POLICIES, "graph", RetryPolicy(max_attempts=3, base_delay=60, max_delay=60))
+    monkeypatch.setattr(RetryPolicy, "backoff", lambda self, attempt: 60.0)
+    runnable = FakeRunnable(TimeoutError("slow"), "answer")
+    with pytest.raises(LLMStageError, match="budget exhausted") as raised:
+        invoke("graph", runnable, "prompt", ReportBudget(5))
+    assert raised.value.attempts == 1
+
+
+def test_failure_report_keeps_completed_sections():
+    failure = LLMStageError("graph", "ValueError: bad graph", 1)
+    explanation = GraphExplanation(graph_title="Spending by Site", explanation="Mostly online.")
+    report = build_failure_report(
+        failure, {"goals": [], "budget": 0}, category_result=ProductCategoryDescriptions(categories=[]),
+        graph_explanations=[explanation, None]
+    )
+    assert report["error"] == failure.to_dict()
+    assert report["graph_explanations"] == [{"title": "Spending by Site", "explanation": "Mostly online."}]
+    assert report["category_analysis"] == {"categories": []}
+    # Sections that failed or were skipped stay empty
+    assert report["brand_analysis"] is None and report["final_advice"] is None
+
+
+def test_failed_shard_cancels_the_others():
+    cancelled = []
+
+    class ShardRunnable:
+        async def ainvoke(self, prompt, config=None):
+            if prompt == "bad":
+                raise ValueError("bad request")
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(prompt)
+                raise
+
+    async def run():
+        with pytest.raises(LLMStageError):
+            await ai_agents._amap_reduce_invoke("graph", ShardRunnable(), ["slow", "bad", "slower"], list)
+        await asyncio.sleep(0)
+        # Checked inside the loop: asyncio.run would cancel leftover tasks on its way out
+        assert sorted(cancelled) == ["slow", "slower"]
+
+    asyncio.run(run())
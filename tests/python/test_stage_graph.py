@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from ai_agents import PersistentLRUCache, PipelineStage, run_stage_graph
+
+
+def run(stages, sources, cache=None, refresh=False):
+    async def collect():
+        return [result async for result in run_stage_graph(stages, sources, cache=cache, refresh=refresh)]
+    return asyncio.run(collect())
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return PersistentLRUCache(str(tmp_path / "stages.sqlite3"), "stage_results")
+
+
+def test_stages_run_in_dependency_order():
+    async def double(value):
+        return value * 2
+
+    stages = [
+        PipelineStage("sum", ["doubled", "x"], lambda doubled, x: doubled + x),
+        PipelineStage("doubled", ["x"], double),
+    ]
+    assert run(stages, {"x": 3}) == [("doubled", 6, False), ("sum", 9, False)]
+
+
+def test_unknown_input_is_rejected():
+    stages = [PipelineStage("a", ["missing"], lambda value: value)]
+    with pytest.raises(ValueError, match="unknown input"):
+        run(stages, {"x": 1})
+
+
+def test_cycle_is_rejected():
+    stages = [
+        PipelineStage("a", ["b"], lambda value: value),
+        PipelineStage("b", ["a"], lambda value: value),
+    ]
+    with pytest.raises(ValueError, match="cycle"):
+        run(stages, {})
+
+
+def test_failure_skips_dependent_stages():
+    calls = []
+    stages = [
+        PipelineStage("fails", ["x"], lambda x: None),
+        PipelineStage("after", ["fails"], lambda value: calls.append(value) or value),
+        PipelineStage("independent", ["x"], lambda x: x + 1),
+    ]
+    assert run(stages, {"x": 1}) == [("fails", None, False), ("after", None, False), ("independent", 2, False)]
+    assert calls == []
+
+
+def test_cache_hits_until_an_input_changes(cache):
+    calls = []
+
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    stages = [PipelineStage("square", ["x"], square, cacheable=True, version="1")]
+    assert run(stages, {"x": 3}, cache) == [("square", 9, False)]
+    assert run(stages, {"x": 3}, cache) == [("square", 9, True)]
+    assert run(stages, {"x": 4}, cache) == [("square", 16, False)]
+    assert run(stages, {"x": 3}, cache, refresh=True) == [("square", 9, False)]
+    assert calls == [3, 4, 3]
+
+
+def test_version_and_upstream_output_key_the_cache(cache):
+    stages = [
+        PipelineStage("parity", ["x"], lambda x: x % 2),
+        PipelineStage("label", ["parity"], lambda parity: ["even", "odd"][parity], cacheable=True, version="1"),
+    ]
+    assert run(stages, {"x": 2}, cache)[-1] == ("label", "even", False)
+    # A different source with the same upstream output reuses the cached result
+    assert run(stages, {"x": 4}, cache)[-1] == ("label", "even", True)
+    stages[1].version = "2"
+    assert run(stages, {"x": 4}, cache)[-1] == ("label", "even", False)
+
+
+def test_failed_outputs_are_not_cached(cache):
+    results = iter([None, 5])
+    stages = [PipelineStage("flaky", ["x"], lambda x: next(results), cacheable=True)]
+    assert run(stages, {"x": 1}, cache) == [("flaky", None, False)]
+    assert run(stages, {"x": 1}, cache) == [("flaky", 5, False)]
+    assert run(stages, {"x": 1}, cache) == [("flaky", 5, True)]